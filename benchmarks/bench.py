@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# Offline benchmarks of IP-Control against local stand-ins for BIRD, DNS
+# and other controllers. Results are written as JSON, so runs can be
+# compared.
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import jsonrpclib
+from ip_control import configuration, dnscache, prefix
+from ip_control.fakebird import FakeBirdServer
+from ip_control.peers import TimeoutTransport
+from standins import StubResolver, start_peers, stop_peers
+
+BIND_IP = '127.0.0.1'
+CONTROL_DOMAIN = 'ip.control.bench'
+CLIENT = 'bench.client.'
+
+def progress(message):
+  sys.stderr.write(message + "\n")
+
+def percentile(values, fraction):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[int(round(fraction * (len(values) - 1)))]
+
+def latency_summary(values):
+  return {
+    'count': len(values),
+    'p50_ms': percentile(values, 0.5) * 1000 if values else None,
+    'p99_ms': percentile(values, 0.99) * 1000 if values else None,
+    'max_ms': max(values) * 1000 if values else None
+  }
+
+def network(base, index):
+  # index-th /32 after base
+  base = prefix.parse(base)
+  return str(prefix.Prefix(4, base.value + index, 32))
+
+class Bench(object):
+  def __init__(self, args):
+    self.args = args
+    self.directory = tempfile.mkdtemp(prefix = 'ip-control-bench-')
+    self.socket_path = os.path.join(self.directory, 'bird.ctl')
+    self.bird = FakeBirdServer(self.socket_path)
+    self.bird.start()
+    self.peer_ips = ['127.0.0.{}'.format(i + 2) for i in range(args.peers)]
+    self.resolver = StubResolver({
+      (CONTROL_DOMAIN, 'A'): [BIND_IP] + self.peer_ips,
+      (CONTROL_DOMAIN, 'TXT'): ['"port={}"'.format(args.port)],
+      (CLIENT, 'A'): [BIND_IP]
+    }, latency = args.dns_latency, default_ptr = CLIENT)
+    dnscache.cache._resolver = self.resolver
+
+  def close(self):
+    self.bird.stop()
+    shutil.rmtree(self.directory, ignore_errors = True)
+
+  def write_config(self, sections, truncate = True):
+    path = os.path.join(self.directory, 'ip-control.conf')
+    output = open(path, 'w')
+    output.write("[General]\n")
+    for option, value in (('ip_control_dns_name', CONTROL_DOMAIN),
+                          ('bird4_dynamic_config', os.path.join(self.directory, 'dynamic_ipv4.conf')),
+                          ('bird4_dynamic_routes', os.path.join(self.directory, 'dynamic_ipv4_routes.conf')),
+                          ('bird4_socket', self.socket_path),
+                          ('bird6_dynamic_config', os.path.join(self.directory, 'dynamic_ipv6.conf')),
+                          ('bird6_dynamic_routes', os.path.join(self.directory, 'dynamic_ipv6_routes.conf')),
+                          ('bird6_reload', 'true'),
+                          ('reload_debounce', self.args.reload_debounce),
+                          ('reload_max_delay', self.args.reload_max_delay),
+                          ('peer_timeout', 5),
+                          # Run all first health checks right away
+                          ('health_check_jitter', 0),
+                          ('persistance_file', os.path.join(self.directory, 'persist'))):
+      output.write("{} = {}\n".format(option, value))
+    for section, options in sections:
+      output.write("\n[{}]\n".format(section))
+      for option, value in options.items():
+        output.write("{} = {}\n".format(option, value))
+    output.close()
+    if truncate:
+      for name in ('dynamic_ipv4.conf', 'dynamic_ipv4_routes.conf', 'dynamic_ipv6.conf', 'dynamic_ipv6_routes.conf'):
+        open(os.path.join(self.directory, name), 'w').close()
+    return configuration.init(path)
+
+  def rpc(self, sections):
+    from ip_control.rpc import RPC
+    self.write_config(sections)
+    dnscache.cache.clear()
+    return RPC((BIND_IP, self.args.port))
+
+  def default_sections(self):
+    return [('10.0.0.0/8', {'interface': 'lo', 'unicast': 'false', 'allowed_hosts': CLIENT}),
+            ('10.255.0.0/16', {'interface': 'lo', 'unicast': 'true', 'allowed_hosts': CLIENT})]
+
+  def bench_configure(self):
+    results = {}
+    for size in self.args.sizes:
+      sections = [(network('10.0.0.0', i), {'interface': 'lo', 'unicast': 'false', 'allowed_hosts': CLIENT}) for i in range(size)]
+      queries = self.resolver.queries
+      started = time.time()
+      rpc = self.rpc(sections)
+      elapsed = time.time() - started
+      rpc._close()
+      results[str(size)] = {'seconds': elapsed, 'dns_queries': self.resolver.queries - queries}
+      progress("configure() with {} sections took {:.3f}s.".format(size, elapsed))
+    return results
+
+  def bench_enable_disable(self):
+    from ip_control.rpc import request_context
+    rpc = self.rpc(self.default_sections())
+    # Calls from a controller are allowed without reverse lookups
+    request_context.client_address = self.peer_ips[0] if self.peer_ips else BIND_IP
+    networks = [network('10.1.0.0', i) for i in range(self.args.operations)]
+    reloads = self.bird.configure_count
+    started = time.time()
+    for i in networks:
+      rpc.enable(i)
+    enabled = time.time() - started
+    started = time.time()
+    for i in networks:
+      rpc.disable(i)
+    disabled = time.time() - started
+    rpc._close()
+    return {
+      'operations': len(networks),
+      'enable_ops_per_second': len(networks) / enabled,
+      'disable_ops_per_second': len(networks) / disabled,
+      'reloads': self.bird.configure_count - reloads
+    }
+
+  def bench_rpc_latency(self):
+    from ip_control.server import ConcurrentJSONRPCServer
+    rpc = self.rpc(self.default_sections())
+    server = ConcurrentJSONRPCServer((BIND_IP, self.args.port), logRequests = False)
+    server.register_instance(rpc)
+    thread = threading.Thread(target = server.serve_forever, name = 'bench-rpc')
+    thread.daemon = True
+    thread.start()
+    peers = start_peers(self.peer_ips, self.args.port, self.args.peer_latency)
+
+    latencies = {'status': [], 'enable': [], 'disable': [], 'enable_unicast': []}
+    lock = threading.Lock()
+    def client(worker):
+      proxy = jsonrpclib.Server('http://{}:{}/'.format(BIND_IP, self.args.port), transport = TimeoutTransport(30))
+      for i in range(worker, self.args.requests, self.args.clients):
+        # Unicast networks are disabled on all peers first
+        for method, args in (('status', (network('10.1.0.0', i),)),
+                             ('enable', (network('10.1.0.0', i),)),
+                             ('disable', (network('10.1.0.0', i),)),
+                             ('enable_unicast', (network('10.255.0.0', i % 65536),))):
+          started = time.time()
+          getattr(proxy, 'enable' if method == 'enable_unicast' else method)(*args)
+          elapsed = time.time() - started
+          lock.acquire()
+          latencies[method].append(elapsed)
+          lock.release()
+
+    started = time.time()
+    clients = [threading.Thread(target = client, args = (i,)) for i in range(self.args.clients)]
+    for i in clients:
+      i.start()
+    for i in clients:
+      i.join()
+    elapsed = time.time() - started
+
+    server.shutdown()
+    server.server_close()
+    stop_peers(peers)
+    rpc._close()
+    results = dict((method, latency_summary(values)) for method, values in latencies.items())
+    results['requests_per_second'] = sum(len(i) for i in latencies.values()) / elapsed
+    results['clients'] = self.args.clients
+    results['peers'] = len(self.peer_ips)
+    return results
+
+  def bench_health_checks(self):
+    # Native TCP checks against a local listener, all should come up
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((BIND_IP, 0))
+    listener.listen(1024)
+    accepting = [True]
+    def accept():
+      while accepting[0]:
+        try:
+          listener.accept()[0].close()
+        except socket.error:
+          break
+    thread = threading.Thread(target = accept, name = 'bench-listener')
+    thread.daemon = True
+    thread.start()
+
+    results = {}
+    for count in self.args.checks:
+      sections = [(network('10.2.0.0', i), {'interface': 'lo', 'unicast': 'false',
+                                            'health_check': 'tcp://{}:{}'.format(BIND_IP, listener.getsockname()[1]),
+                                            'health_check_interval': 3600, 'health_check_timeout': 5})
+                  for i in range(count)]
+      started = time.time()
+      rpc = self.rpc(sections)
+      configured = time.time()
+      bird = rpc._bird[4]
+      while len(bird.networks) < count and time.time() - configured < 60:
+        time.sleep(0.01)
+      elapsed = time.time() - configured
+      results[str(count)] = {'seconds': elapsed, 'healthy': len(bird.networks), 'configure_seconds': configured - started}
+      rpc._close()
+      progress("{} health checks came up in {:.3f}s.".format(count, elapsed))
+    accepting[0] = False
+    listener.close()
+    return results
+
+  def bench_restart(self):
+    # Loading enabled networks from the state store and from BIRD configs
+    from ip_control.bird import BirdConfig
+    results = {}
+    for size in self.args.sizes:
+      self.write_config(self.default_sections())
+      bird = BirdConfig(4)
+      bird.update(add = [network('10.0.0.0', i) for i in range(size)])
+      bird.save()
+      bird.close()
+
+      started = time.time()
+      BirdConfig(4).close()
+      from_bird = time.time() - started
+
+      # Keep BIRD configs written above, the state store takes them over
+      config = self.write_config(self.default_sections(), truncate = False)
+      config.set('General', 'state_directory', os.path.join(self.directory, 'state-{}'.format(size)))
+      BirdConfig(4).close()
+      started = time.time()
+      BirdConfig(4).close()
+      from_state = time.time() - started
+      results[str(size)] = {'bird_config_seconds': from_bird, 'state_store_seconds': from_state}
+      progress("Loading {} networks took {:.3f}s from BIRD configs, {:.3f}s from state store.".format(size, from_bird, from_state))
+    return results
+
+  def bench_reloads(self):
+    from ip_control.bird import BirdConfig
+    self.write_config(self.default_sections())
+    bird = BirdConfig(4)
+    reloads = self.bird.configure_count
+    saves = 0
+    deadline = time.time() + self.args.duration
+    started = time.time()
+    while time.time() < deadline:
+      target = network('10.3.0.0', saves)
+      bird.add_network(target)
+      bird.save()
+      saves += 1
+    elapsed = time.time() - started
+    bird.close()
+    return {
+      'networks': saves,
+      'reloads': self.bird.configure_count - reloads,
+      'reloads_per_second': (self.bird.configure_count - reloads) / elapsed
+    }
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                   stderr = open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+BENCHMARKS = ['configure', 'enable_disable', 'rpc_latency', 'health_checks', 'reloads', 'restart']
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Benchmarks IP-Control against local stand-ins of BIRD, DNS and peers.')
+  parser.add_argument('benchmarks', nargs = '*', metavar = 'benchmark',
+                      help = 'Benchmarks to run, all by default: {}.'.format(', '.join(BENCHMARKS)))
+  parser.add_argument('--output', '-o', type = str, help = 'Write results as JSON into this file.')
+  parser.add_argument('--sizes', type = int, nargs = '+', default = [100, 10000, 100000],
+                      help = 'Number of sections for configure().')
+  parser.add_argument('--checks', type = int, nargs = '+', default = [100, 1000],
+                      help = 'Number of health checks.')
+  parser.add_argument('--operations', type = int, default = 10000, help = 'Number of enables and disables.')
+  parser.add_argument('--requests', type = int, default = 1000, help = 'Number of RPC request rounds.')
+  parser.add_argument('--clients', type = int, default = 4, help = 'Number of concurrent RPC clients.')
+  parser.add_argument('--peers', type = int, default = 3, help = 'Number of fake peer controllers.')
+  parser.add_argument('--peer-latency', type = float, default = 0.0, help = 'Seconds fake peers take to answer.')
+  parser.add_argument('--dns-latency', type = float, default = 0.0, help = 'Seconds stub DNS takes to answer.')
+  parser.add_argument('--reload-debounce', type = float, default = 0.05)
+  parser.add_argument('--reload-max-delay', type = float, default = 0.5)
+  parser.add_argument('--duration', type = float, default = 5, help = 'Seconds to measure reloads for.')
+  parser.add_argument('--port', type = int, default = 18750, help = 'Port of the controller and its peers.')
+  args = parser.parse_args()
+  for name in args.benchmarks:
+    if name not in BENCHMARKS:
+      parser.error("unknown benchmark {}".format(name))
+
+  logging.basicConfig(level = logging.ERROR, format = "%(asctime)s - %(levelname)s: %(message)s")
+  bench = Bench(args)
+  results = {
+    'meta': {
+      'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'revision': git_revision(),
+      'python': platform.python_version(),
+      'arguments': vars(args)
+    }
+  }
+  try:
+    for name in args.benchmarks or BENCHMARKS:
+      progress("Running {}.".format(name))
+      started = time.time()
+      results[name] = getattr(bench, 'bench_' + name)()
+      results[name]['wall_seconds'] = time.time() - started
+  finally:
+    bench.close()
+
+  body = json.dumps(results, indent = 2, sort_keys = True)
+  if args.output:
+    open(args.output, 'w').write(body + "\n")
+  print body
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+import time
+import threading
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+from ip_control.server import ConcurrentJSONRPCServer
+
+class _Answer(object):
+  # Just enough of dns.resolver.Answer for the DNS cache
+  def __init__(self, rrset):
+    self.rrset = rrset
+
+  def __iter__(self):
+    return iter(self.rrset)
+
+  def __len__(self):
+    return len(self.rrset)
+
+class StubResolver(object):
+  # Answers from a fixed table after a configurable delay, in place of
+  # dns.resolver.Resolver
+  def __init__(self, records, latency = 0, ttl = 300, default_ptr = None):
+    self.records = dict((self._key(name, rdtype), texts) for (name, rdtype), texts in records.items())
+    self.latency = latency
+    self.ttl = ttl
+    self.default_ptr = default_ptr
+    self.lifetime = None
+    self.queries = 0
+
+  def _key(self, name, rdtype):
+    return str(name).lower().rstrip('.'), rdtype
+
+  def query(self, name, rdtype = 'A'):
+    self.queries += 1
+    if self.latency:
+      time.sleep(self.latency)
+    texts = self.records.get(self._key(name, rdtype))
+    if texts is None and rdtype == 'PTR' and self.default_ptr:
+      texts = [self.default_ptr]
+    if texts is None:
+      raise dns.resolver.NXDOMAIN()
+    return _Answer(dns.rrset.from_text(str(name), self.ttl, 'IN', rdtype, *texts))
+
+class FakePeer(object):
+  # Other controller, answering after a configurable delay
+  def __init__(self, latency = 0):
+    self.latency = latency
+    self.enabled = set([])
+    self._lock = threading.Lock()
+
+  def status(self, network):
+    if self.latency:
+      time.sleep(self.latency)
+    return 'enabled' if network in self.enabled else 'disabled'
+
+  def disable(self, network):
+    if self.latency:
+      time.sleep(self.latency)
+    self._lock.acquire()
+    self.enabled.discard(network)
+    self._lock.release()
+    return True
+
+def start_peers(ips, port, latency = 0):
+  # One JSON-RPC server per peer, all on the same port like real controllers
+  servers = []
+  for ip in ips:
+    server = ConcurrentJSONRPCServer((ip, port), logRequests = False)
+    server.register_instance(FakePeer(latency))
+    thread = threading.Thread(target = server.serve_forever, name = 'peer-{}'.format(ip))
+    thread.daemon = True
+    thread.start()
+    servers.append(server)
+  return servers
+
+def stop_peers(servers):
+  for server in servers:
+    server.shutdown()
+    server.server_close()
@@ -1,6 +1,4 @@
 #!/usr/bin/python
-from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, \
-                                           SimpleJSONRPCRequestHandler
 import argparse
 from ip_control import configuration
 import os
@@ -56,6 +54,8 @@ logging.config.dictConfig({
 config = configuration.init(args.config)
 
 from ip_control.rpc import RPC
+from ip_control.server import ConcurrentJSONRPCServer
+from ip_control import dnscache, metrics
 import dns.resolver
 import subprocess
 import re
@@ -64,16 +64,10 @@ import re
 def reconfigure(_a, _b):
   global rpc_instance, config
   config = configuration.init(args.config)
-  rpc_instance.configure()
+  dnscache.cache.configure(config)
+  rpc_instance._reconfigure()
 signal.signal(signal.SIGHUP, reconfigure)
 
-class RequestHandler(SimpleJSONRPCRequestHandler):
-  def __init__(self, request, client_address, server):
-    global rpc_instance
-    rpc_instance.client_address, _ = client_address
-
-    SimpleJSONRPCRequestHandler.__init__(self, request, client_address, server)
-
 def get_bind_info():
   # Get bind information
   try:
@@ -81,7 +75,7 @@ def get_bind_info():
     hostname = subprocess.check_output(['hostname', '-f']).strip()
     # Resolve it
     logging.info("Resolving %s.", hostname)
-    bind_ip = dns.resolver.query(hostname)[0].to_text()
+    bind_ip = dnscache.query(hostname)[0].to_text()
   except subprocess.CalledProcessError:
     logging.error("Unable to retrieve router's hostname.")
     return None
@@ -93,7 +87,7 @@ def get_bind_info():
     control_domain = config.get('General', 'ip_control_dns_name')
     # Get bind port
     logging.info("Resolving %s TXT record.", control_domain)
-    bind_port = dns.resolver.query(control_domain, 'TXT')[0].to_text()
+    bind_port = dnscache.query(control_domain, 'TXT')[0].to_text()
     logging.info("Resolved to %s.", bind_port)
   except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
     logging.error("Unable to resolve %s TXT record to fetch bind port.", control_domain)
@@ -108,6 +102,9 @@ def get_bind_info():
 
   return (bind_ip, bind_port)
 
+# Setup DNS cache
+dnscache.cache.configure(config)
+
 # First, init dynamic routes
 # Check for persistance (bootup or daemon restart)
 persistance_file = config.get('General', 'persistance_file')
@@ -122,6 +119,11 @@ if not os.path.exists(persistance_file):
   open(config.get('General', 'bird4_dynamic_routes'), 'w')
   open(config.get('General', 'bird6_dynamic_config'), 'w')
   open(config.get('General', 'bird6_dynamic_routes'), 'w')
+  # Forget stored state as well
+  if config.has_option('General', 'state_directory'):
+    from ip_control.state import StateStore
+    StateStore(config.get('General', 'state_directory'), 4).clear()
+    StateStore(config.get('General', 'state_directory'), 6).clear()
 
 # Setup our server
 bind_info = None
@@ -136,11 +138,17 @@ while not bind_info:
     import time
     time.sleep(5)
 rpc_instance = RPC(bind_info)
-server = SimpleJSONRPCServer((rpc_instance.bind_ip, rpc_instance.bind_port),
-                             requestHandler = RequestHandler)
+server = ConcurrentJSONRPCServer((rpc_instance.bind_ip, rpc_instance.bind_port),
+                                 workers = config.getint('General', 'rpc_workers') if config.has_option('General', 'rpc_workers') else 4,
+                                 max_connections = config.getint('General', 'rpc_max_connections') if config.has_option('General', 'rpc_max_connections') else 256)
 
 server.register_instance(rpc_instance)
 
+# Optional endpoint for Prometheus
+if config.has_option('General', 'metrics_port'):
+  metrics.start_http_server(config.getint('General', 'metrics_port'),
+                            config.get('General', 'metrics_address') if config.has_option('General', 'metrics_address') else '')
+
 # Start it up
 logging.info("Listening for requests.")
 import select
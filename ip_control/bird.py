@@ -1,34 +1,88 @@
 import re
-import netaddr
 import os.path
-from datetime import datetime
 import subprocess
 import logging
 import threading
+import time
+import collections
+from ip_control.futures import Future
+from ip_control.birdctl import BirdControl, BirdControlError, BirdReplyError
+from ip_control import metrics, prefix
+from ip_control.radix import PrefixTrie
+from ip_control.render import ConfigRenderer, atomic_write, digest, read_digest
+from ip_control.state import StateError, StateStore
+# Kept here for backwards compatibility
+from ip_control.healthcheck import HealthCheckDaemon
+
+_write_seconds = metrics.registry.histogram('bird_write_seconds', 'Time spent writing BIRD config files.', ['family'])
+_reload_seconds = metrics.registry.histogram('bird_reload_seconds', 'Time spent reloading BIRD.', ['family'])
+_saves = metrics.registry.counter('bird_saves_total', 'Saves of BIRD configuration by outcome.', ['family', 'outcome'])
+
+# Immutable view of enabled networks, replaced as a whole on every change
+Snapshot = collections.namedtuple('Snapshot', ['generation', 'networks'])
 
 class BirdConfig(object):
   _network_re = re.compile(r'^\s*stubnet\s+([^;]+);\s*$')
+  # Members of an aggregated announcement
+  _member_re = re.compile(r'^\s*#\s*enabled\s+(\S+)\s*$')
 
-  def __init__(self, version):
+  def __init__(self, version, changelog = None):
     from ip_control.configuration import config
-    self._networks = set([])
+    self._snapshot = Snapshot(0, frozenset())
+    # Changes are recorded in changelog once loaded
+    self._changelog = None
+    self._write_lock = threading.Lock()
+    # Index of enabled networks for prefix queries, guarded by write lock and
+    # built when first needed
+    self._index = None
+    # Enabled networks whose interface may have changed since the last render
+    self._relocated = set([])
+    self._state = None
     self.version = 6 if str(version) == '6' else 4
     self._filepath = config.get('General', 'bird{}_dynamic_config'.format(self.version))
     self._filepath_routes = config.get('General', 'bird{}_dynamic_routes'.format(self.version))
     self._prepare_path()
 
     # Prepare commands
-    self._reload = config.get('General', 'bird{}_reload'.format(self.version))
+    self._reload = config.get('General', 'bird{}_reload'.format(self.version)) if config.has_option('General', 'bird{}_reload'.format(self.version)) else None
+    self._control = None
+    if config.has_option('General', 'bird{}_socket'.format(self.version)):
+      self._control = BirdControl(config.get('General', 'bird{}_socket'.format(self.version)))
+
+    # Prepare save scheduling
+    self._save_lock = threading.Lock()
+    self._scheduler = None
+    self._scheduler_lock = threading.Lock()
+    self._closed = False
+    self._reload_debounce = config.getfloat('General', 'reload_debounce') if config.has_option('General', 'reload_debounce') else 0.5
+    self._reload_max_delay = config.getfloat('General', 'reload_max_delay') if config.has_option('General', 'reload_max_delay') else 5.0
 
-    # Load all networks
-    self._interfaces = {}
-    for network in (i for i in config.sections() if i != 'General'):
-      self._interfaces[netaddr.IPNetwork(network)] = config.get(network, 'interface')
+    # Merge announcements on all or some interfaces
+    self._aggregate_all = config.getboolean('General', 'bird{}_aggregate'.format(self.version)) if config.has_option('General', 'bird{}_aggregate'.format(self.version)) else False
+    self._aggregate_interfaces = set([])
+    if config.has_option('General', 'bird{}_aggregate_interfaces'.format(self.version)):
+      self._aggregate_interfaces = set(i.strip() for i in config.get('General', 'bird{}_aggregate_interfaces'.format(self.version)).split(',') if i.strip())
 
-    # Load configs
-    if os.path.exists(self._filepath):
+    # Load all networks. The trie is replaced as a whole on every change,
+    # so it can be read without the write lock.
+    self._interfaces = PrefixTrie()
+    for network in (i for i in config.sections() if i != 'General' and config.has_option(i, 'interface')):
+      self._interfaces[prefix.parse(network)] = config.get(network, 'interface')
+
+    # Load enabled networks from state store, or from BIRD configs without one
+    if config.has_option('General', 'state_directory'):
+      self._load_state(StateStore(config.get('General', 'state_directory'), self.version))
+    elif os.path.exists(self._filepath):
       self._load()
 
+    self._changelog = changelog
+
+    # Remember what BIRD currently has, to skip no-op reloads
+    self._renderer = ConfigRenderer()
+    # Networks, interfaces and routes of the last routes() call
+    self._routes = None
+    self._digests = (read_digest(self._filepath), read_digest(self._filepath_routes))
+
   def _cmd(self, cmd, **kwargs):
     return getattr(self, '_' + cmd).format(**kwargs).split(' ')
 
@@ -38,8 +92,87 @@ class BirdConfig(object):
       # Create path
       os.makedirs(path)
 
-  def _get_interface(self, network):
-    return self._interfaces.get(network, 'lo')
+  def _get_interface(self, network, interfaces = None):
+    # Most specific configured network decides the interface
+    match = (interfaces if interfaces is not None else self._interfaces).longest_match(network)
+    return match[1] if match else 'lo'
+
+  def _aggregate(self, interface):
+    return self._aggregate_all or interface in self._aggregate_interfaces
+
+  def set_interface(self, network, interface):
+    # Returns whether rendered routes may have changed
+    network = prefix.parse(network)
+    self._write_lock.acquire()
+    try:
+      if self._interfaces.get(network) == interface:
+        return False
+      interfaces = self._interfaces.copy()
+      interfaces[network] = interface
+      self._interfaces = interfaces
+      return self._relocate(network)
+    finally:
+      self._write_lock.release()
+
+  def remove_interface(self, network):
+    network = prefix.parse(network)
+    self._write_lock.acquire()
+    try:
+      if network not in self._interfaces:
+        return False
+      interfaces = self._interfaces.copy()
+      del interfaces[network]
+      self._interfaces = interfaces
+      return self._relocate(network)
+    finally:
+      self._write_lock.release()
+
+  def _relocate(self, network):
+    # Networks within a changed section are looked up again on next render
+    relocated = [i for i, _ in self._get_index().within(network)]
+    self._relocated.update(relocated)
+    return bool(relocated)
+
+  def routes(self):
+    # Enabled networks and their interfaces, not to be changed by the caller.
+    # Only networks changed since the last call are looked up, unless
+    # interfaces have changed.
+    interfaces, networks = self._interfaces, self._snapshot.networks
+    previous = self._routes
+    if previous and previous[1] is interfaces:
+      routes = dict(previous[2])
+      for network in previous[0] - networks:
+        del routes[network]
+      for network in networks - previous[0]:
+        routes[network] = self._get_interface(network, interfaces)
+    else:
+      routes = dict((network, self._get_interface(network, interfaces)) for network in networks)
+    self._routes = (networks, interfaces, routes)
+    return routes
+
+  def _get_index(self):
+    if self._index is None:
+      self._index = PrefixTrie()
+      for network in self._snapshot.networks:
+        self._index[network] = True
+    return self._index
+
+  def _load_state(self, state):
+    started = time.time()
+    try:
+      networks = state.load()
+    except StateError as e:
+      logging.error('Cannot load state of IPv%d (%s), loading BIRD configs instead.', self.version, e)
+      networks = None
+    if networks is None:
+      # First start with a state store, take over what BIRD has
+      if os.path.exists(self._filepath):
+        self._load()
+      state.compact(self._snapshot.networks)
+    else:
+      self._snapshot = Snapshot(1, frozenset(networks))
+    self._state = state
+    logging.info('Loaded %d networks for IPv%d in %.3fs.', len(self._snapshot.networks), self.version, time.time() - started)
 
   def _load(self):
     logging.info('Loading existing routes for IPv%d from BIRD configs', self.version)
@@ -49,106 +182,250 @@ class BirdConfig(object):
       logging.exception('Cannot open %s for reading.', self._filepath)
       raise
 
+    networks = []
     for line in c:
-      match = self._network_re.match(line)
+      match = self._network_re.match(line) or self._member_re.match(line)
       if match:
         logging.info('Loaded network %s', match.group(1))
-        self.add_network(match.group(1))
+        networks.append(match.group(1))
+    self.update(add = networks)
 
-  def add_network(self, network):
-    network = netaddr.IPNetwork(network)
+  def update(self, add = (), remove = ()):
+    add = frozenset(prefix.parse(i) for i in add)
+    remove = frozenset(prefix.parse(i) for i in remove)
+
+    # Writers publish a new snapshot, readers never lock
+    self._write_lock.acquire()
+    try:
+      networks = self._snapshot.networks
+      removed = remove & networks
+      added = add - networks
+      if not (added or removed):
+        return False
+      if self._state:
+        try:
+          self._state.append(enabled = added, disabled = removed)
+        except (IOError, OSError):
+          logging.exception('Cannot journal changes of IPv%d networks.', self.version)
+      if self._index is not None:
+        for network in removed:
+          del self._index[network]
+        for network in added:
+          self._index[network] = True
+      self._snapshot = Snapshot(self._snapshot.generation + 1, (networks - removed) | added)
+      if self._changelog:
+        self._changelog.record(enabled = added, disabled = removed)
+      return True
+    finally:
+      self._write_lock.release()
 
-    self._networks.add(network)
+  def add_network(self, network):
+    return self.update(add = [network])
 
   def remove_network(self, network):
-    network = netaddr.IPNetwork(network)
+    return self.update(remove = [network])
 
-    if network not in self._networks:
-      return
+  def has_network(self, network):
+    network = prefix.parse(network)
+    return network in self._snapshot.networks
 
-    self._networks.remove(network)
+  def networks_within(self, supernet):
+    supernet = prefix.parse(supernet)
+    self._write_lock.acquire()
+    try:
+      return [i for i, _ in self._get_index().within(supernet)]
+    finally:
+      self._write_lock.release()
 
-  def has_network(self, network):
-    network = netaddr.IPNetwork(network)
-    return network in self._networks
+  @property
+  def snapshot(self):
+    return self._snapshot
+
+  @property
+  def generation(self):
+    return self._snapshot.generation
 
   @property
   def networks(self):
-    return set(self._networks)
+    return self._snapshot.networks
+
+  def schedule_save(self):
+    self._scheduler_lock.acquire()
+    try:
+      if self._closed:
+        # Replaced by a new config, nothing will be written anymore
+        future = Future()
+        future.set_result(False)
+        return future
+      if not self._scheduler:
+        self._scheduler = SaveScheduler(self, self._reload_debounce, self._reload_max_delay)
+        self._scheduler.start()
+      scheduler = self._scheduler
+    finally:
+      self._scheduler_lock.release()
+    return scheduler.request()
+
+  def close(self):
+    # Flush pending changes and stop the scheduler
+    self._scheduler_lock.acquire()
+    self._closed = True
+    scheduler, self._scheduler = self._scheduler, None
+    self._scheduler_lock.release()
+    if scheduler:
+      scheduler.stop()
+    if self._control:
+      self._control.close()
+    # Changes made after closing are not journaled anymore
+    self._write_lock.acquire()
+    state, self._state = self._state, None
+    self._write_lock.release()
+    if state:
+      state.close()
 
   def save(self):
-    # Make up list of routes
-    announcements = []
-    for network in self._networks:
-      announcements.append('stubnet {};'.format(network))
-    routes = []
-    for network in self._networks:
-      routes.append('route {} via "{}";'.format(network, self._get_interface(network)))
+    self._save_lock.acquire()
+    try:
+      return self._save()
+    finally:
+      self._save_lock.release()
+
+  def _reload_bird(self):
+    if self._control:
+      try:
+        code, lines = self._control.configure()
+        logging.info('Reconfigured bird%d over control socket: %s', self.version, ' '.join(lines))
+        return
+      except BirdReplyError:
+        # BIRD refused the configuration, reload command would not help
+        raise
+      except BirdControlError:
+        if not self._reload:
+          raise
+        logging.exception('Cannot reconfigure bird%d over control socket, falling back to reload command.', self.version)
+    subprocess.check_call(self._cmd('reload'))
+
+  def _save(self):
+    # Render routes and skip everything if nothing has changed. Returns
+    # whether BIRD has the current routes.
+    state = self._state
+    self._write_lock.acquire()
+    snapshot, interfaces = self._snapshot, self._interfaces
+    relocated, self._relocated = self._relocated, set([])
+    self._write_lock.release()
+    # Writers only wait for compaction, which is prepared without them
+    if state and state.needs_compaction(len(snapshot.networks)):
+      packed = state.pack(snapshot.networks)
+      self._write_lock.acquire()
+      try:
+        # Changes made meanwhile are journaled already and have to be included
+        networks = self._snapshot.networks
+        state.compact(networks, packed if networks is snapshot.networks else None)
+      except (IOError, OSError):
+        logging.exception('Cannot compact state of IPv%d networks.', self.version)
+      finally:
+        self._write_lock.release()
+    announcements, routes = self._renderer.render(snapshot.networks, lambda network: self._get_interface(network, interfaces), self._aggregate, relocated)
+    # State has to be durable before BIRD announces it
+    if state:
+      try:
+        state.sync()
+      except (IOError, OSError):
+        logging.exception('Cannot sync state of IPv%d networks.', self.version)
+    digests = (digest(announcements), digest(routes))
+    if digests == self._digests:
+      logging.info('Routes for IPv%d have not changed, skipping BIRD reload.', self.version)
+      _saves.inc(family = self.version, outcome = 'unchanged')
+      return True
+    self._digests = None
 
     # Create/rewrite config files
     logging.info('Writing routes for IPv%d to BIRD configs', self.version)
-    try:
-      output_ann = open(self._filepath, 'w')
-      output_ann.write("# Generated by ip-control at {}. Do not touch this file!\n".format(str(datetime.now())))
-      output_ann.write("\n".join(announcements))
-      output_ann.close()
-    except:
-      logging.exception('Cannot open %s for writing.', self._filepath)
-    try:
-      output_routes = open(self._filepath_routes, 'w')
-      output_routes.write("# Generated by ip-control at {}. Do not touch this file!\n".format(str(datetime.now())))
-      output_routes.write("\n".join(routes))
-      output_routes.close()
-    except:
-      logging.exception('Cannot open %s for writing.', self._filepath)
+    with _write_seconds.time(family = self.version):
+      for filepath, body in ((self._filepath, announcements), (self._filepath_routes, routes)):
+        try:
+          atomic_write(filepath, body)
+        except:
+          logging.exception('Cannot write %s.', filepath)
+          _saves.inc(family = self.version, outcome = 'write_failed')
+          return False
     # Reload our bird
     try:
-      subprocess.check_call(self._cmd('reload'))
+      with _reload_seconds.time(family = self.version):
+        self._reload_bird()
     except:
       logging.exception('Got exception when reloading bird%d', self.version)
+      _saves.inc(family = self.version, outcome = 'reload_failed')
+      return False
+    self._digests = digests
+    _saves.inc(family = self.version, outcome = 'reloaded')
+    return True
 
-class HealthCheckDaemon(threading.Thread):
-  def __init__(self, bird_daemon, *args, **kwargs):
-    super(HealthCheckDaemon, self).__init__(*args, **kwargs)
+class SaveScheduler(threading.Thread):
+  def __init__(self, bird_config, debounce, max_delay, *args, **kwargs):
+    super(SaveScheduler, self).__init__(*args, **kwargs)
+    self.daemon = True
 
-    self._bird_daemon = bird_daemon
-    self._networks = {}
+    self._bird_config = bird_config
+    self._debounce = debounce
+    self._max_delay = max_delay
     self._lock = threading.Condition()
     self._running = True
+    self._pending = []
+    self._first_change = None
+    self._last_change = None
 
-  def add_network(self, network, cmd):
+  def request(self):
+    future = Future()
     self._lock.acquire()
-    self._networks[network] = cmd
+    if not self._running:
+      # Stopped after the last flush, nobody would complete it
+      self._lock.release()
+      future.set_result(False)
+      return future
+    now = time.time()
+    if self._first_change is None:
+      self._first_change = now
+    self._last_change = now
+    self._pending.append(future)
     self._lock.notify()
     self._lock.release()
+    return future
 
   def stop(self):
     self._lock.acquire()
     self._running = False
     self._lock.notify()
     self._lock.release()
+    self.join()
 
   def run(self):
     self._lock.acquire()
-    while self._running:
-      change = False
-      # Check networks
-      for network, hc in self._networks.items():
-        if not subprocess.call(hc, shell = True):
-          if not self._bird_daemon.has_network(network):
-            logging.info("Health check for network %s has succeeded, enabling it.", network)
-            self._bird_daemon.add_network(network)
-            change = True
-        else:
-          if self._bird_daemon.has_network(network):
-            logging.warning("Health check for network %s has failed, disabling it.", network)
-            self._bird_daemon.remove_network(network)
-            change = True
-
-      # Save the configuration
-      if change:
-        self._bird_daemon.save()
-
-      # Let's wait for next loop
-      self._lock.wait(5)
+    while True:
+      if self._first_change is None:
+        if not self._running:
+          break
+        self._lock.wait()
+        continue
+
+      # Wait for changes to settle, but not longer than max delay
+      deadline = min(self._last_change + self._debounce, self._first_change + self._max_delay)
+      delay = deadline - time.time()
+      if delay > 0 and self._running:
+        self._lock.wait(delay)
+        continue
+
+      pending, self._pending = self._pending, []
+      self._first_change = self._last_change = None
+      self._lock.release()
+      logging.info('Flushing %d change(s) for IPv%d.', len(pending), self._bird_config.version)
+      try:
+        result = self._bird_config.save()
+      except Exception as e:
+        logging.exception('Got exception when flushing changes for IPv%d', self._bird_config.version)
+        for future in pending:
+          future.set_exception(e)
+      else:
+        for future in pending:
+          future.set_result(result)
+      self._lock.acquire()
     self._lock.release()
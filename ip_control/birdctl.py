@@ -0,0 +1,94 @@
+import re
+import socket
+import logging
+import threading
+
+class BirdControlError(Exception):
+  pass
+
+class BirdReplyError(BirdControlError):
+  def __init__(self, code, lines):
+    super(BirdReplyError, self).__init__("BIRD replied with {}: {}".format(code, ' '.join(lines)))
+    self.code = code
+    self.lines = lines
+
+class BirdControl(object):
+  _reply_re = re.compile(r'^(\d{4})([ -])(.*)$')
+
+  def __init__(self, path, timeout = 30):
+    self._path = path
+    self._timeout = timeout
+    self._socket = None
+    self._buffer = ''
+    self._lock = threading.Lock()
+
+  def _connect(self):
+    logging.info('Connecting to BIRD control socket %s.', self._path)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.settimeout(self._timeout)
+    self._buffer = ''
+    self._socket.connect(self._path)
+    # BIRD greets us with 0001 when ready
+    code, lines = self._read_reply()
+    if code != 1:
+      raise BirdControlError("Unexpected greeting from BIRD: {} {}".format(code, ' '.join(lines)))
+
+  def close(self):
+    if self._socket:
+      try:
+        self._socket.close()
+      except socket.error:
+        pass
+      self._socket = None
+
+  def _read_line(self):
+    while '\n' not in self._buffer:
+      data = self._socket.recv(4096)
+      if not data:
+        raise socket.error("Connection closed by BIRD.")
+      self._buffer += data
+    line, self._buffer = self._buffer.split('\n', 1)
+    return line
+
+  def _read_reply(self):
+    lines = []
+    while True:
+      line = self._read_line()
+      match = self._reply_re.match(line)
+      if match:
+        lines.append(match.group(3))
+        if match.group(2) == ' ':
+          return int(match.group(1)), lines
+      elif line.startswith(' '):
+        # Continuation of the previous code
+        lines.append(line[1:])
+      elif line.startswith('+'):
+        # Asynchronous notification, not part of our reply
+        continue
+      else:
+        raise BirdControlError("Malformed reply from BIRD: {}".format(line))
+
+  def request(self, command):
+    self._lock.acquire()
+    try:
+      # Retry once on a fresh connection if the old one went away
+      for attempt in (1, 2):
+        try:
+          if not self._socket:
+            self._connect()
+          self._socket.sendall(command + '\n')
+          return self._read_reply()
+        except socket.error as e:
+          self.close()
+          if attempt == 2:
+            raise BirdControlError("Cannot talk to BIRD over {}: {}".format(self._path, e))
+          logging.warning('Lost connection to BIRD control socket %s, reconnecting.', self._path)
+    finally:
+      self._lock.release()
+
+  def configure(self):
+    code, lines = self.request('configure')
+    # Codes from 8000 up are run-time and parse errors
+    if code >= 8000:
+      raise BirdReplyError(code, lines)
+    return code, lines
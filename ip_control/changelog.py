@@ -0,0 +1,77 @@
+import time
+import random
+import threading
+import collections
+
+Event = collections.namedtuple('Event', ['seq', 'network', 'status'])
+
+# Low bits of sequences count changes, high bits tell the run. Together
+# they stay below 2**53, so clients parsing JSON numbers as doubles keep
+# them exact.
+_COUNTER_BITS = 32
+_RUN_BITS = 20
+
+class Changelog(object):
+  # Recent changes of enabled networks, numbered by a sequence which only
+  # grows. Sequences carry a random id of the run, so those of a previous
+  # run are never mistaken for ours, however many changes either had.
+  def __init__(self, size = 10000):
+    self._events = collections.deque(maxlen = size)
+    self._run = random.SystemRandom().getrandbits(_RUN_BITS)
+    self._seq = self._run << _COUNTER_BITS
+    # Nothing before it is known, even while no event is kept
+    self._start = self._seq
+    self._lock = threading.Condition()
+    self._listeners = []
+
+  @property
+  def seq(self):
+    return self._seq
+
+  def subscribe(self, callback):
+    # Called without arguments after every recorded change
+    self._listeners.append(callback)
+
+  def record(self, enabled = (), disabled = ()):
+    self._lock.acquire()
+    try:
+      for network, status in [(i, 'enabled') for i in enabled] + [(i, 'disabled') for i in disabled]:
+        self._seq += 1
+        self._events.append(Event(self._seq, network, status))
+      self._lock.notify_all()
+    finally:
+      self._lock.release()
+    for callback in self._listeners:
+      callback()
+
+  def _complete(self, since):
+    # Whether events after since are all still kept
+    return since >> _COUNTER_BITS == self._run and self._start <= since <= self._seq and \
+           (not self._events or since >= self._events[0].seq - 1)
+
+  def since(self, since, networks = None, timeout = 0):
+    # Events after since for networks (all if None), waiting up to timeout
+    # for one. Returns (seq, events, reset), reset is true if the log does
+    # not reach back to since anymore.
+    deadline = time.time() + timeout
+    self._lock.acquire()
+    try:
+      while True:
+        if not self._complete(since):
+          return self._seq, [], True
+        # Newest events are at the end
+        events = []
+        for event in reversed(self._events):
+          if event.seq <= since:
+            break
+          if networks is None or event.network in networks:
+            events.append(event)
+        events.reverse()
+        remaining = deadline - time.time()
+        if events or remaining <= 0:
+          return self._seq, events, False
+        # Nothing for us yet, skip what has been seen
+        since = self._seq
+        self._lock.wait(remaining)
+    finally:
+      self._lock.release()
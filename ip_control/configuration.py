@@ -22,25 +22,81 @@ bird4_dynamic_config = /var/cache/bird/dynamic_ipv4.conf
 bird4_dynamic_routes = /var/cache/bird/dynamic_ipv4_routes.conf
 # Bird reload command (make sure to config sudoers)
 bird4_reload = sudo service bird reload
+# Bird control socket, if set BIRD is reconfigured over it and the
+# reload command is used only as a fallback
+#bird4_socket = /var/run/bird/bird.ctl
 # Bird6 configuration file we are editing
 bird6_dynamic_config = /var/cache/bird/dynamic_ipv6.conf
 # Bird6 configuration file we are editing for adding routes
 bird6_dynamic_routes = /var/cache/bird/dynamic_ipv6_routes.conf
 # Bird6 reload command (make sure to config sudoers)
 bird6_reload = sudo service bird6 reload
-# Command to be executed when adding route
-add_route = sudo ip ro add {network} dev {interface}
-# Command to be executed when removing route
-remove_route = sudo ip ro add {network} dev {interface}
-# Command to be executed when checking IPv4 route
-ipv4_check_route = ip ro sh dev {interface} | grep "scope link" | grep {network}
-# Command to be executed when checking IPv6 route
-ipv6_check_route = ip -6 ro sh dev {interface} | grep "scope link" | grep {network}
+# Bird6 control socket
+#bird6_socket = /var/run/bird/bird6.ctl
+# Merge adjacent networks on the same interface into the smallest set of
+# covering prefixes before announcing them, either on all interfaces
+# or only on the listed ones. Status is still reported per network.
+#bird4_aggregate = false
+#bird4_aggregate_interfaces = lo, eth0
+#bird6_aggregate = false
+#bird6_aggregate_interfaces = lo
+# Changes are written to BIRD in the background. A flush happens once no
+# change was made for reload_debounce seconds, but at most reload_max_delay
+# seconds after the first pending change.
+reload_debounce = 0.5
+reload_max_delay = 5
+# Number of health checks run in parallel per address family
+health_check_workers = 8
+# Random spread of health check runs, as a fraction of their interval
+health_check_jitter = 0.1
+# DNS answers are cached according to their TTL. Negative answers are
+# cached for at most dns_negative_ttl seconds. Expired answers are used
+# for dns_stale_grace seconds while they are refreshed in background.
+dns_cache_size = 1024
+dns_negative_ttl = 30
+dns_stale_grace = 300
+# Seconds after which a DNS lookup is given up
+dns_timeout = 5
+# Number of allowed hosts validated in parallel on (re)configuration
+dns_workers = 16
+# Seconds to wait for other controllers when enabling an unicast IP
+peer_timeout = 5
+# Number of other controllers contacted in parallel
+peer_workers = 16
+# Replicate owners of unicast IPs between controllers, so enabling one
+# asks only its current owner to disable it. Has to be set on all
+# controllers, changing it requires a restart.
+replicate_ownership = false
+# Seconds between full synchronizations of ownership with other controllers
+ownership_sync_interval = 60
+# Number of requests changing networks served at the same time, read-only
+# requests like status are always served immediately
+rpc_workers = 4
+# Maximum number of open client connections, further clients have to wait
+rpc_max_connections = 256
+# Serve metrics for Prometheus at http://<metrics_address>:<metrics_port>/metrics,
+# the same numbers are available over the stats RPC method
+#metrics_port = 9810
+#metrics_address = 127.0.0.1
+# Program routes of enabled networks into the kernel directly, over netlink
+# (needs CAP_NET_ADMIN). Kernel routes are compared with enabled networks
+# after every change and periodically, only routes of route_protocol in
+# route_table are changed. Leave it unset if BIRD's kernel protocol
+# exports the routes.
+#route_backend = netlink
+#route_protocol = 211
+#route_table = 254
+# Seconds between reconciliations repairing routes changed by others
+#route_reconcile_interval = 30
 # A file for checking persistance, if file doesn't exist
 # it will revert all previously enabled routes and
 # create this file for ensuring persistance after restart.
 # Make sure this file gets removed upon machine restart
 persistance_file = /tmp/persistant-routes
+# Directory keeping enabled networks in a journal with periodic snapshots,
+# loaded quickly on restart. BIRD configs are then only written, without
+# it enabled networks are read back from them.
+state_directory = /var/lib/ip-control
 
 # A section dedicated to a specific IP network
 [10.2.xxx.xxx/32]
@@ -53,6 +109,30 @@ unicast = false
 # Do note, if health check is specified, the route will be added when the command
 # successfully exits, it ignores the RPC part
 health_check = curl -s -o /dev/null http://this.is.my.ct.on.host.internal_zone
+# Health checks can also be probed natively without running a command:
+#   tcp://host:port                  - succeeds when connection is accepted
+#   http://host[:port]/path          - succeeds on 2xx/3xx or health_check_status
+#   dns://server[:port]/name?type=A  - succeeds when server answers the query
+#health_check = http://this.is.my.ct.on.host.internal_zone/
+# Comma separated HTTP status codes expected from http:// health check
+#health_check_status = 200
+# Seconds between health checks
+health_check_interval = 5
+# Seconds after which a running health check is killed and counted as failed
+health_check_timeout = 5
+# Consecutive successes needed to enable, and failures needed to disable the network
+health_check_rise = 1
+health_check_fall = 1
+# Dampen a flapping network: every change adds health_check_flap_penalty,
+# halved each health_check_half_life seconds. Above health_check_suppress
+# the network stays disabled until the penalty decays below
+# health_check_reuse, but at most health_check_max_suppress seconds.
+#health_check_dampening = true
+#health_check_half_life = 900
+#health_check_flap_penalty = 1000
+#health_check_suppress = 2000
+#health_check_reuse = 750
+#health_check_max_suppress = 3600
 # Interface to add route to
 interface = lxc0
 """
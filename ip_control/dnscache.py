@@ -0,0 +1,147 @@
+import time
+import logging
+import threading
+import collections
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+from ip_control import metrics
+from ip_control.pool import WorkerPool
+
+_query_seconds = metrics.registry.histogram('dns_query_seconds', 'Duration of DNS queries, including cached answers.', ['type'])
+_lookup_seconds = metrics.registry.histogram('dns_lookup_seconds', 'Duration of DNS lookups sent to the resolver.', ['type'])
+_answers = metrics.registry.counter('dns_answers_total', 'DNS queries by source of the answer.', ['type', 'source'])
+
+class CacheEntry(object):
+  def __init__(self, answer, error, ttl):
+    self.answer = answer
+    self.error = error
+    self.fetched = time.time()
+    self.expires = self.fetched + ttl
+
+  def result(self):
+    if self.error is not None:
+      raise self.error
+    return self.answer
+
+class DNSCache(object):
+  def __init__(self, max_size = 1024, negative_ttl = 30, stale_grace = 300, refresh_ahead = 0.8, timeout = 5):
+    self.max_size = max_size
+    self.negative_ttl = negative_ttl
+    self.stale_grace = stale_grace
+    self.refresh_ahead = refresh_ahead
+    self.timeout = timeout
+    self._entries = collections.OrderedDict()
+    self._refreshing = set([])
+    self._lock = threading.Lock()
+    self._resolver = None
+    self._pool = None
+
+  def configure(self, config):
+    for option, attribute, get in (('dns_cache_size', 'max_size', config.getint),
+                                   ('dns_negative_ttl', 'negative_ttl', config.getfloat),
+                                   ('dns_stale_grace', 'stale_grace', config.getfloat),
+                                   ('dns_timeout', 'timeout', config.getfloat)):
+      if config.has_option('General', option):
+        setattr(self, attribute, get('General', option))
+    if self._resolver:
+      self._resolver.lifetime = self.timeout
+
+  def _get_resolver(self):
+    if not self._resolver:
+      self._resolver = dns.resolver.Resolver()
+      self._resolver.lifetime = self.timeout
+    return self._resolver
+
+  def _negative_ttl(self, error):
+    # Use SOA of the negative answer if we have one, but not more than configured
+    ttl = self.negative_ttl
+    response = None
+    if isinstance(error, dns.resolver.NoAnswer):
+      response = error.kwargs.get('response')
+    elif isinstance(error, dns.resolver.NXDOMAIN) and error.kwargs.get('responses'):
+      response = error.kwargs['responses'].values()[0]
+    if response is not None:
+      for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+          ttl = min(ttl, rrset.ttl, rrset[0].minimum)
+    return ttl
+
+  def _fetch(self, key):
+    name, rdtype = key
+    with _lookup_seconds.time(type = rdtype):
+      try:
+        answer = self._get_resolver().query(name, rdtype)
+        entry = CacheEntry(list(answer), None, answer.rrset.ttl)
+      except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+        entry = CacheEntry(None, e, self._negative_ttl(e))
+
+    self._lock.acquire()
+    self._entries.pop(key, None)
+    self._entries[key] = entry
+    while len(self._entries) > self.max_size:
+      self._entries.popitem(last = False)
+    self._lock.release()
+    return entry
+
+  def _refresh(self, key):
+    try:
+      self._fetch(key)
+    except dns.exception.DNSException as e:
+      logging.warning("Background refresh of %s %s failed: %s", key[0], key[1], e)
+    finally:
+      self._lock.acquire()
+      self._refreshing.discard(key)
+      self._lock.release()
+
+  def query(self, name, rdtype = 'A'):
+    with _query_seconds.time(type = rdtype):
+      return self._query(name, rdtype)
+
+  def _query(self, name, rdtype):
+    key = (str(name).lower(), rdtype)
+    now = time.time()
+
+    self._lock.acquire()
+    entry = self._entries.pop(key, None)
+    if entry:
+      # Keep recently used entries at the end
+      self._entries[key] = entry
+    # Expired entries are used during stale grace as well, so a resolver
+    # which is down never holds up queries of known names
+    usable = entry is not None and now < entry.expires + self.stale_grace
+    refresh = False
+    if usable and key not in self._refreshing:
+      # Refresh in background when entry is close to expiring or expired,
+      # only once at a time
+      if now - entry.fetched > (entry.expires - entry.fetched) * self.refresh_ahead:
+        self._refreshing.add(key)
+        refresh = True
+        if not self._pool:
+          self._pool = WorkerPool(2, name = 'dns-refresh')
+    self._lock.release()
+
+    if usable:
+      if refresh:
+        self._pool.submit(self._refresh, key)
+      _answers.inc(type = rdtype, source = 'cache' if now < entry.expires else 'stale')
+      return entry.result()
+
+    try:
+      entry = self._fetch(key)
+    except dns.exception.DNSException:
+      _answers.inc(type = rdtype, source = 'error')
+      raise
+    _answers.inc(type = rdtype, source = 'resolver')
+    return entry.result()
+
+  def clear(self):
+    self._lock.acquire()
+    self._entries.clear()
+    self._lock.release()
+
+# Shared cache
+cache = DNSCache()
+
+def query(name, rdtype = 'A'):
+  return cache.query(name, rdtype)
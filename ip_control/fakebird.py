@@ -0,0 +1,94 @@
+import os
+import os.path
+import socket
+import logging
+import argparse
+import threading
+
+class FakeBirdServer(threading.Thread):
+  def __init__(self, path, *args, **kwargs):
+    super(FakeBirdServer, self).__init__(*args, **kwargs)
+    self.daemon = True
+
+    self.path = path
+    self.configure_count = 0
+    # Set to an error message to make configure fail
+    self.fail = None
+    self._lock = threading.Lock()
+    self._connections = set([])
+    if os.path.exists(path):
+      os.unlink(path)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.bind(path)
+    self._socket.listen(5)
+
+  def stop(self):
+    self._socket.close()
+    self._lock.acquire()
+    for connection in self._connections:
+      try:
+        connection.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+    self._lock.release()
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+  def _reply(self, line):
+    command = line.strip()
+    if command == 'configure':
+      self._lock.acquire()
+      self.configure_count += 1
+      self._lock.release()
+      logging.info('Got configure request.')
+      if self.fail:
+        return '8002 {}\n'.format(self.fail)
+      return '0002-Reading configuration from /etc/bird.conf\n0003 Reconfigured\n'
+    return '9001 Unknown command {}\n'.format(command)
+
+  def _serve(self, connection):
+    f = connection.makefile('r')
+    try:
+      connection.sendall('0001 BIRD 1.6.3 ready.\n')
+      for line in f:
+        if line.strip() == 'quit':
+          connection.sendall('0000\n')
+          break
+        connection.sendall(self._reply(line))
+    except socket.error:
+      pass
+    finally:
+      f.close()
+      connection.close()
+      self._lock.acquire()
+      self._connections.discard(connection)
+      self._lock.release()
+
+  def run(self):
+    while True:
+      try:
+        connection, _ = self._socket.accept()
+      except socket.error:
+        break
+      self._lock.acquire()
+      self._connections.add(connection)
+      self._lock.release()
+      threading.Thread(target = self._serve, args = (connection,)).start()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Fake BIRD control socket for testing IP Control.')
+  parser.add_argument('path', type = str, help = 'Path of the control socket to create.')
+  parser.add_argument('--fail', dest = 'fail', type = str, default = None,
+                      help = 'Reply to configure with this error message.')
+  args = parser.parse_args()
+
+  logging.basicConfig(level = logging.INFO, format = "%(asctime)s - %(levelname)s: %(message)s")
+  server = FakeBirdServer(args.path)
+  server.fail = args.fail
+  server.start()
+  logging.info('Listening on %s.', args.path)
+  try:
+    while server.is_alive():
+      server.join(1)
+  except KeyboardInterrupt:
+    server.stop()
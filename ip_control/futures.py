@@ -0,0 +1,55 @@
+import threading
+
+class TimeoutError(Exception):
+  pass
+
+class Future(object):
+  def __init__(self):
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._callbacks = []
+    self._result = None
+    self._exception = None
+
+  def _finish(self):
+    self._lock.acquire()
+    callbacks, self._callbacks = self._callbacks, []
+    self._done.set()
+    self._lock.release()
+    for callback in callbacks:
+      callback(self)
+
+  def set_result(self, result):
+    self._result = result
+    self._finish()
+
+  def set_exception(self, exception):
+    self._exception = exception
+    self._finish()
+
+  def add_done_callback(self, callback):
+    self._lock.acquire()
+    if not self._done.is_set():
+      self._callbacks.append(callback)
+      self._lock.release()
+      return
+    self._lock.release()
+    callback(self)
+
+  def done(self):
+    return self._done.is_set()
+
+  def wait(self, timeout = None):
+    return self._done.wait(timeout)
+
+  def exception(self, timeout = None):
+    if not self._done.wait(timeout):
+      raise TimeoutError("Operation did not finish in {} seconds.".format(timeout))
+    return self._exception
+
+  def result(self, timeout = None):
+    if not self._done.wait(timeout):
+      raise TimeoutError("Operation did not finish in {} seconds.".format(timeout))
+    if self._exception is not None:
+      raise self._exception
+    return self._result
@@ -0,0 +1,271 @@
+import os
+import heapq
+import random
+import signal
+import logging
+import itertools
+import math
+import threading
+import subprocess
+import time
+from ip_control import metrics
+from ip_control.futures import Future
+from ip_control.pool import WorkerPool
+from ip_control.probes import ProbeLoop, parse_probe
+
+_run_seconds = metrics.registry.histogram('health_check_seconds', 'Duration of health check runs.', ['family', 'kind'])
+_results = metrics.registry.counter('health_checks_total', 'Health check runs by outcome.', ['family', 'kind', 'outcome'])
+_flaps = metrics.registry.counter('health_check_flaps_total', 'Changes of health checked networks counted by dampening.', ['family'])
+_suppressions = metrics.registry.counter('health_check_suppressions_total', 'Networks suppressed by dampening.', ['family'])
+
+def run_command(cmd, timeout):
+  # Run in own process group, so the whole shell pipeline can be killed
+  process = subprocess.Popen(cmd, shell = True, preexec_fn = os.setsid)
+  timed_out = []
+  def kill():
+    timed_out.append(True)
+    try:
+      os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+      pass
+  timer = threading.Timer(timeout, kill)
+  timer.start()
+  try:
+    returncode = process.wait()
+  finally:
+    timer.cancel()
+  if timed_out:
+    logging.warning("Health check '%s' timed out after %s seconds.", cmd, timeout)
+    return False
+  return returncode == 0
+
+class Dampening(object):
+  # Penalty of a flapping network, decaying exponentially as in BGP route
+  # flap dampening (RFC 2439). Above suppress the network is held disabled,
+  # it is reused once the penalty decays below reuse.
+  def __init__(self, half_life = 900, flap_penalty = 1000, suppress = 2000, reuse = 750, max_suppress = 3600):
+    if half_life <= 0 or not 0 < reuse < suppress:
+      raise ValueError("dampening needs a positive half life and 0 < reuse < suppress")
+    self.half_life = half_life
+    self.flap_penalty = flap_penalty
+    self.suppress = suppress
+    self.reuse = reuse
+    # Penalty never grows above what decays to reuse in max_suppress
+    self.ceiling = reuse * 2 ** (float(max_suppress) / half_life)
+    self.penalty = 0.0
+    self.flaps = 0
+    self.suppressed = False
+    self._updated = time.time()
+
+  def _decay(self, now):
+    self.penalty *= 2 ** (-(now - self._updated) / self.half_life)
+    self._updated = now
+
+  def flap(self, now):
+    self._decay(now)
+    self.penalty = min(self.penalty + self.flap_penalty, self.ceiling)
+    self.flaps += 1
+
+  def update(self, now):
+    # Returns whether suppression has changed
+    self._decay(now)
+    suppressed = self.penalty > self.suppress or (self.suppressed and self.penalty >= self.reuse)
+    changed = suppressed != self.suppressed
+    self.suppressed = suppressed
+    return changed
+
+  def state(self, now):
+    penalty = self.penalty * 2 ** (-(now - self._updated) / self.half_life)
+    state = {
+      'penalty': round(penalty, 1),
+      'flaps': self.flaps,
+      'suppressed': self.suppressed,
+      'suppress': self.suppress,
+      'reuse': self.reuse,
+      'half_life': self.half_life
+    }
+    if self.suppressed:
+      # Time until reuse if it does not flap anymore
+      state['reuse_in'] = round(max(0, self.half_life * math.log(penalty / self.reuse, 2)), 1)
+    return state
+
+class HealthCheck(object):
+  def __init__(self, network, cmd, interval = 5, timeout = 5, rise = 1, fall = 1, status = None, dampening = False, **dampening_options):
+    self.network = network
+    self.cmd = cmd
+    # URL-like checks are probed in-process, everything else goes to shell
+    self.probe = parse_probe(cmd, status)
+    self.interval = interval
+    self.timeout = timeout
+    self.rise = rise
+    self.fall = fall
+    self.successes = 0
+    self.failures = 0
+    self.started = None
+    # Last decided state, changes of it are flaps
+    self.healthy = None
+    self.dampening = Dampening(**dampening_options) if dampening else None
+
+  def run(self):
+    return run_command(self.cmd, self.timeout)
+
+class HealthCheckDaemon(threading.Thread):
+  def __init__(self, bird_daemon, workers = 8, jitter = 0.1, *args, **kwargs):
+    super(HealthCheckDaemon, self).__init__(*args, **kwargs)
+    self.daemon = True
+
+    self._bird_daemon = bird_daemon
+    self._workers = workers
+    self._jitter = jitter
+    self._checks = {}
+    # Heap of (due time, sequence, check)
+    self._queue = []
+    self._sequence = itertools.count()
+    self._lock = threading.Condition()
+    self._running = True
+
+  def _schedule(self, check, due):
+    heapq.heappush(self._queue, (due, next(self._sequence), check))
+
+  def _spread(self, interval):
+    return interval * random.uniform(-self._jitter, self._jitter)
+
+  def add_network(self, network, cmd, **kwargs):
+    self._lock.acquire()
+    check = HealthCheck(network, cmd, **kwargs)
+    self._checks[network] = check
+    # Spread first runs over the interval
+    self._schedule(check, time.time() + random.uniform(0, check.interval * self._jitter))
+    self._lock.notify()
+    self._lock.release()
+
+  def remove_network(self, network):
+    self._lock.acquire()
+    self._checks.pop(network, None)
+    self._lock.release()
+
+  def stop(self):
+    self._lock.acquire()
+    self._running = False
+    self._lock.notify()
+    self._lock.release()
+
+  def _dispatch(self, check):
+    if not check.probe:
+      self._pool.submit(check.run).add_done_callback(lambda future: self._complete(check, future))
+    elif check.probe.resolved():
+      self._probes.submit(check.probe, check.timeout).add_done_callback(lambda future: self._complete(check, future))
+    else:
+      # Resolve the probe's host off the scheduler thread first
+      self._pool.submit(check.probe.resolve).add_done_callback(lambda future: self._resolved(check, future))
+
+  def _resolved(self, check, future):
+    if future.exception() is not None:
+      logging.warning("Cannot resolve health check %s: %s", check.probe, future.exception())
+      failed = Future()
+      failed.set_result(False)
+      self._complete(check, failed)
+      return
+    self._probes.submit(check.probe, check.timeout).add_done_callback(lambda future: self._complete(check, future))
+
+  def _complete(self, check, future):
+    try:
+      healthy = future.result()
+      outcome = 'success' if healthy else 'failure'
+    except Exception:
+      logging.exception("Health check for network %s failed to run.", check.network)
+      healthy = False
+      outcome = 'error'
+    kind = check.probe.scheme if check.probe else 'command'
+    _run_seconds.observe(time.time() - check.started, family = self._bird_daemon.version, kind = kind)
+    _results.inc(family = self._bird_daemon.version, kind = kind, outcome = outcome)
+
+    change = False
+    self._lock.acquire()
+    try:
+      # Ignore results of removed checks
+      if not self._running or self._checks.get(check.network) is not check:
+        return
+      change = self._record(check, healthy)
+      self._schedule(check, max(time.time(), check.started + check.interval + self._spread(check.interval)))
+      self._lock.notify()
+    finally:
+      self._lock.release()
+
+    # Schedule saving of the configuration
+    if change:
+      self._bird_daemon.schedule_save()
+
+  def _record(self, check, healthy):
+    if healthy:
+      check.successes += 1
+      check.failures = 0
+      verdict = True if check.successes >= check.rise else None
+    else:
+      check.failures += 1
+      check.successes = 0
+      verdict = False if check.failures >= check.fall else None
+
+    if check.dampening:
+      now = time.time()
+      if verdict is not None and check.healthy is not None and verdict != check.healthy:
+        check.dampening.flap(now)
+        _flaps.inc(family = self._bird_daemon.version)
+      if check.dampening.update(now):
+        if check.dampening.suppressed:
+          logging.warning("Network %s is flapping (penalty %.0f), suppressing it.", check.network, check.dampening.penalty)
+          _suppressions.inc(family = self._bird_daemon.version)
+        else:
+          logging.info("Network %s has stopped flapping (penalty %.0f), reusing it.", check.network, check.dampening.penalty)
+    if verdict is not None:
+      check.healthy = verdict
+
+    enabled = self._bird_daemon.has_network(check.network)
+    if check.dampening and check.dampening.suppressed:
+      # Held disabled whatever the health check says
+      if enabled:
+        self._bird_daemon.remove_network(check.network)
+        return True
+      return False
+    if verdict and not enabled:
+      logging.info("Health check for network %s has succeeded, enabling it.", check.network)
+      self._bird_daemon.add_network(check.network)
+      return True
+    if verdict is False and enabled:
+      logging.warning("Health check for network %s has failed, disabling it.", check.network)
+      self._bird_daemon.remove_network(check.network)
+      return True
+    return False
+
+  def dampening(self, network = None):
+    # Dampening state of one network, or of all dampened networks
+    now = time.time()
+    self._lock.acquire()
+    try:
+      if network is not None:
+        check = self._checks.get(network)
+        return check.dampening.state(now) if check and check.dampening else None
+      return dict((str(network), check.dampening.state(now)) for network, check in self._checks.items() if check.dampening)
+    finally:
+      self._lock.release()
+
+  def run(self):
+    self._pool = WorkerPool(self._workers, name = 'health-check-ipv{}'.format(self._bird_daemon.version))
+    self._probes = ProbeLoop(name = 'health-probe-ipv{}'.format(self._bird_daemon.version))
+    self._probes.start()
+    self._lock.acquire()
+    while self._running:
+      # Start all checks which are due
+      now = time.time()
+      while self._queue and self._queue[0][0] <= now:
+        _, _, check = heapq.heappop(self._queue)
+        if self._checks.get(check.network) is not check:
+          continue
+        check.started = now
+        self._dispatch(check)
+
+      # Let's wait for next due check
+      self._lock.wait(self._queue[0][0] - now if self._queue else None)
+    self._lock.release()
+    self._pool.shutdown()
+    self._probes.stop()
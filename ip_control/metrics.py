@@ -0,0 +1,176 @@
+import bisect
+import logging
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# Seconds, from a millisecond up to the slowest reloads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class _Metric(object):
+  kind = None
+
+  def __init__(self, name, help, labels = ()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _key(self, labels):
+    return tuple(str(labels.get(i, '')) for i in self.labels)
+
+class Counter(_Metric):
+  kind = 'counter'
+
+  def inc(self, amount = 1, **labels):
+    key = self._key(labels)
+    self._lock.acquire()
+    self._values[key] = self._values.get(key, 0) + amount
+    self._lock.release()
+
+  def snapshot(self):
+    self._lock.acquire()
+    values = dict(self._values)
+    self._lock.release()
+    return [(dict(zip(self.labels, key)), value) for key, value in sorted(values.items())]
+
+  def samples(self):
+    for labels, value in self.snapshot():
+      yield self.name, labels, value
+
+class Histogram(_Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    # Fixed buckets, so recording is a bisect and three additions
+    key = self._key(labels)
+    index = bisect.bisect_left(self.buckets, value)
+    self._lock.acquire()
+    try:
+      counts = self._values.get(key)
+      if counts is None:
+        counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+      counts[0][index] += 1
+      counts[1] += 1
+      counts[2] += value
+    finally:
+      self._lock.release()
+
+  def time(self, **labels):
+    return _Timer(self, labels)
+
+  def snapshot(self):
+    self._lock.acquire()
+    values = dict((key, (list(counts[0]), counts[1], counts[2])) for key, counts in self._values.items())
+    self._lock.release()
+    result = []
+    for key, (buckets, count, total) in sorted(values.items()):
+      cumulative = []
+      running = 0
+      for bound, value in zip(self.buckets + ('+Inf',), buckets):
+        running += value
+        cumulative.append((bound, running))
+      result.append((dict(zip(self.labels, key)), {'count': count, 'sum': total, 'buckets': cumulative}))
+    return result
+
+  def samples(self):
+    for labels, value in self.snapshot():
+      for bound, count in value['buckets']:
+        bucket_labels = dict(labels)
+        bucket_labels['le'] = bound
+        yield self.name + '_bucket', bucket_labels, count
+      yield self.name + '_count', labels, value['count']
+      yield self.name + '_sum', labels, value['sum']
+
+class _Timer(object):
+  def __init__(self, histogram, labels):
+    self._histogram = histogram
+    self._labels = labels
+
+  def __enter__(self):
+    self._started = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._histogram.observe(time.time() - self._started, **self._labels)
+
+class Registry(object):
+  def __init__(self):
+    self._metrics = []
+    self._lock = threading.Lock()
+
+  def register(self, metric):
+    self._lock.acquire()
+    self._metrics.append(metric)
+    self._lock.release()
+    return metric
+
+  def counter(self, name, help, labels = ()):
+    return self.register(Counter(name, help, labels))
+
+  def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+    return self.register(Histogram(name, help, labels, buckets))
+
+  def stats(self):
+    # JSON friendly view of all metrics
+    stats = {}
+    for metric in list(self._metrics):
+      values = []
+      for labels, value in metric.snapshot():
+        if metric.kind == 'histogram':
+          value = dict(value, buckets = [[str(bound), count] for bound, count in value['buckets']])
+        values.append({'labels': labels, 'value': value})
+      stats[metric.name] = {'type': metric.kind, 'help': metric.help, 'values': values}
+    return stats
+
+  def prometheus(self):
+    # Prometheus text exposition format
+    lines = []
+    for metric in list(self._metrics):
+      lines.append('# HELP {} {}'.format(metric.name, metric.help))
+      lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+      for name, labels, value in metric.samples():
+        if labels:
+          name += '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items())) + '}'
+        lines.append('{} {}'.format(name, repr(float(value)) if isinstance(value, float) else value))
+    return "\n".join(lines) + "\n"
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Shared registry
+registry = Registry()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = registry.prometheus()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def start_http_server(port, address = ''):
+  # Serve /metrics for Prometheus in a background thread
+  server = _MetricsServer((address, port), _MetricsHandler)
+  thread = threading.Thread(target = server.serve_forever, name = 'metrics')
+  thread.daemon = True
+  thread.start()
+  logging.info("Serving metrics on %s:%d.", address or '*', port)
+  return server
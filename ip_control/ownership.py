@@ -0,0 +1,168 @@
+import time
+import hashlib
+import logging
+import threading
+import collections
+from ip_control import prefix
+
+# Owner is the controller's IP, or None once it gave the network up
+Entry = collections.namedtuple('Entry', ['owner', 'epoch'])
+
+def _newer(a, b):
+  # Higher epoch wins, owner breaks ties so all controllers agree
+  return (a.epoch, a.owner or '') > (b.epoch, b.owner or '')
+
+class OwnershipTable(object):
+  # Who announces which unicast network, replicated between controllers
+  def __init__(self):
+    self._entries = {}
+    self._digest = None
+    self._lock = threading.Lock()
+
+  def get(self, network):
+    return self._entries.get(prefix.parse(network))
+
+  def _set(self, network, owner):
+    self._lock.acquire()
+    try:
+      current = self._entries.get(network)
+      entry = Entry(owner, current.epoch + 1 if current else 1)
+      self._entries[network] = entry
+      self._digest = None
+      return entry
+    finally:
+      self._lock.release()
+
+  def claim(self, network, owner):
+    return self._set(prefix.parse(network), owner)
+
+  def release(self, network):
+    return self._set(prefix.parse(network), None)
+
+  def merge(self, network, entry):
+    # Returns previous entry if the received one replaced it
+    network = prefix.parse(network)
+    entry = Entry(*entry)
+    self._lock.acquire()
+    try:
+      current = self._entries.get(network)
+      if current and not _newer(entry, current):
+        return None
+      self._entries[network] = entry
+      self._digest = None
+      return current or Entry(None, 0)
+    finally:
+      self._lock.release()
+
+  def items(self):
+    self._lock.acquire()
+    items = self._entries.items()
+    self._lock.release()
+    return items
+
+  def to_wire(self, items = None):
+    return [[str(network), entry.owner, entry.epoch] for network, entry in (self.items() if items is None else items)]
+
+  def digest(self):
+    digest = self._digest
+    if digest is None:
+      digest = hashlib.sha1("\n".join(sorted('{} {} {}'.format(*i) for i in self.to_wire()))).hexdigest()
+      self._digest = digest
+    return digest
+
+class Replicator(threading.Thread):
+  # Pushes ownership changes to other controllers and synchronizes whole
+  # tables with controllers which may have missed some
+  def __init__(self, table, peers, controllers, merged, interval = 60, retry = 5, *args, **kwargs):
+    super(Replicator, self).__init__(*args, **kwargs)
+    self.daemon = True
+    self.name = 'ownership'
+    self._table = table
+    self._peers = peers
+    # Callable returning other controllers as Peer objects
+    self._controllers = controllers
+    # Called with (network, previous entry, entry) for every merged change
+    self._merged = merged
+    self._interval = interval
+    self._retry = retry
+    self._pending = []
+    self._synced = set([])
+    self._lock = threading.Condition()
+    self._running = True
+
+  def push(self, network, entry):
+    self._lock.acquire()
+    self._pending.append((network, entry))
+    self._lock.notify()
+    self._lock.release()
+
+  def synced(self, controllers):
+    # Whether the table has everything of the given controllers
+    return all(str(i) in self._synced for i in controllers)
+
+  def merge(self, entries):
+    for network, owner, epoch in entries:
+      entry = Entry(str(owner) if owner else None, int(epoch))
+      previous = self._table.merge(network, entry)
+      if previous is not None:
+        self._merged(prefix.parse(network), previous, entry)
+
+  def stop(self):
+    self._lock.acquire()
+    self._running = False
+    self._lock.notify()
+    self._lock.release()
+
+  def _push(self, controllers, pending):
+    entries = self._table.to_wire(pending)
+    results = self._peers.fan_out(controllers, lambda peer: peer.call('ownership_update', entries))
+    for controller, (outcome, result) in results.items():
+      if outcome != 'ok':
+        # It missed changes, synchronize it again
+        logging.warning("Cannot replicate ownership to controller %s: %s", controller, result or outcome)
+        self._synced.discard(str(controller))
+
+  def _sync(self, controller):
+    if controller.call('ownership_digest') != self._table.digest():
+      self.merge(controller.call('ownership_exchange', self._table.to_wire()))
+    self._synced.add(str(controller))
+
+  def run(self):
+    last_full = 0
+    next_sync = time.time()
+    self._lock.acquire()
+    while self._running:
+      now = time.time()
+      if not self._pending and now < next_sync:
+        self._lock.wait(next_sync - now)
+        continue
+      pending, self._pending = self._pending, []
+      self._lock.release()
+
+      try:
+        controllers = self._controllers()
+        # Forget controllers which are gone
+        self._synced &= set(str(i) for i in controllers)
+        if pending:
+          self._push(controllers, pending)
+        if time.time() >= next_sync:
+          # Everybody once per interval, those which missed changes sooner
+          full = time.time() >= last_full + self._interval
+          if full:
+            last_full = time.time()
+          for controller in controllers:
+            if full or str(controller) not in self._synced:
+              try:
+                self._sync(controller)
+              except Exception as e:
+                logging.warning("Cannot synchronize ownership with controller %s: %s", controller, e)
+                self._synced.discard(str(controller))
+          next_sync = last_full + self._interval
+          if not self.synced(controllers):
+            next_sync = min(next_sync, time.time() + self._retry)
+      except Exception:
+        logging.exception("Ownership replication failed.")
+        next_sync = time.time() + self._retry
+
+      self._lock.acquire()
+    self._lock.release()
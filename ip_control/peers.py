@@ -0,0 +1,96 @@
+import time
+import threading
+import jsonrpclib
+from jsonrpclib.jsonrpc import Transport
+from ip_control import metrics
+from ip_control.pool import WorkerPool
+
+_fan_out_seconds = metrics.registry.histogram('peer_fan_out_seconds', 'Time until all controllers answered or timed out.')
+_calls = metrics.registry.counter('peer_calls_total', 'Calls to other controllers by outcome.', ['outcome'])
+
+class TimeoutTransport(Transport):
+  def __init__(self, timeout, source_address = None):
+    Transport.__init__(self)
+    self.timeout = timeout
+    self.source_address = source_address
+
+  def make_connection(self, host):
+    # Connection is cached by the transport, so HTTP keep-alive is reused
+    connection = Transport.make_connection(self, host)
+    connection.timeout = self.timeout
+    if self.source_address:
+      connection.source_address = self.source_address
+    if connection.sock:
+      connection.sock.settimeout(self.timeout)
+    return connection
+
+  def send_content(self, connection, request_body):
+    # Send headers together with the body, as a separate small write
+    # would wait for the delayed ACK of the headers
+    connection.putheader("Content-Type", "application/json-rpc")
+    connection.putheader("Content-Length", str(len(request_body)))
+    connection.endheaders(request_body)
+
+class Peer(object):
+  def __init__(self, ip, port, timeout, source_ip = None):
+    self.ip = ip
+    self._server = jsonrpclib.Server("http://{}:{}/".format(ip, port),
+                                     transport = TimeoutTransport(timeout, (source_ip, 0) if source_ip else None))
+    self._lock = threading.Lock()
+
+  def call(self, method, *args):
+    # One request at a time over the peer's connection
+    self._lock.acquire()
+    try:
+      return getattr(self._server, method)(*args)
+    finally:
+      self._lock.release()
+
+  def __str__(self):
+    return str(self.ip)
+
+class PeerPool(object):
+  def __init__(self, port, timeout = 5, workers = 16, source_ip = None):
+    self.port = port
+    self.timeout = timeout
+    # Other controllers recognize us by the address we connect from
+    self.source_ip = source_ip
+    self._peers = {}
+    self._lock = threading.Lock()
+    self._pool = WorkerPool(workers, name = 'peer')
+
+  def get(self, ip):
+    self._lock.acquire()
+    try:
+      peer = self._peers.get(ip)
+      if not peer:
+        peer = Peer(ip, self.port, self.timeout, self.source_ip)
+        self._peers[ip] = peer
+      return peer
+    finally:
+      self._lock.release()
+
+  def prune(self, ips):
+    # Forget connections to peers which are gone
+    self._lock.acquire()
+    for ip in [i for i in self._peers if i not in ips]:
+      del self._peers[ip]
+    self._lock.release()
+
+  def fan_out(self, peers, function):
+    # Run function(peer) for all peers concurrently, returns
+    # peer -> ('ok', result), ('error', exception) or ('timeout', None)
+    started = time.time()
+    futures = [(peer, self._pool.submit(function, peer)) for peer in peers]
+    deadline = started + self.timeout
+    results = {}
+    for peer, future in futures:
+      if not future.wait(max(0, deadline - time.time())):
+        results[peer] = ('timeout', None)
+      elif future.exception() is not None:
+        results[peer] = ('error', future.exception())
+      else:
+        results[peer] = ('ok', future.result())
+      _calls.inc(outcome = results[peer][0])
+    _fan_out_seconds.observe(time.time() - started)
+    return results
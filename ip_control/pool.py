@@ -0,0 +1,38 @@
+import Queue
+import logging
+import threading
+from ip_control.futures import Future
+
+class WorkerPool(object):
+  def __init__(self, workers, name = 'worker'):
+    self._queue = Queue.Queue()
+    self._threads = []
+    for i in range(max(1, workers)):
+      thread = threading.Thread(target = self._work, name = '{}-{}'.format(name, i))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _work(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        break
+      future, function, args, kwargs = item
+      try:
+        result = function(*args, **kwargs)
+      except Exception as e:
+        logging.debug('Task %s raised %s', function, e)
+        future.set_exception(e)
+      else:
+        future.set_result(result)
+
+  def submit(self, function, *args, **kwargs):
+    future = Future()
+    self._queue.put((future, function, args, kwargs))
+    return future
+
+  def shutdown(self):
+    # Let workers finish queued tasks and exit
+    for _ in self._threads:
+      self._queue.put(None)
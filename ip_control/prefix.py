@@ -0,0 +1,128 @@
+import socket
+import struct
+import binascii
+import functools
+import netaddr
+
+_widths = {4: 32, 6: 128}
+
+@functools.total_ordering
+class Prefix(object):
+  # Compact network: IP version, integer network address and prefix length
+  __slots__ = ('version', 'value', 'prefixlen', '_hash')
+
+  def __init__(self, version, value, prefixlen):
+    width = _widths[version]
+    if not 0 <= prefixlen <= width:
+      raise netaddr.AddrFormatError("invalid prefix length {} for IPv{}".format(prefixlen, version))
+    host_bits = width - prefixlen
+    self.version = version
+    self.value = value >> host_bits << host_bits
+    self.prefixlen = prefixlen
+    self._hash = hash((version, self.value, prefixlen))
+
+  @property
+  def first(self):
+    return self.value
+
+  @property
+  def last(self):
+    return self.value | ((1 << (_widths[self.version] - self.prefixlen)) - 1)
+
+  @property
+  def address(self):
+    if self.version == 4:
+      return socket.inet_ntop(socket.AF_INET, struct.pack('!I', self.value))
+    return socket.inet_ntop(socket.AF_INET6, binascii.unhexlify('%032x' % self.value))
+
+  def __contains__(self, other):
+    return other.version == self.version and other.prefixlen >= self.prefixlen and \
+           other.value >> (_widths[self.version] - self.prefixlen) == self.value >> (_widths[self.version] - self.prefixlen)
+
+  def __eq__(self, other):
+    if not isinstance(other, Prefix):
+      return NotImplemented
+    return self.version == other.version and self.value == other.value and self.prefixlen == other.prefixlen
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  def __lt__(self, other):
+    if not isinstance(other, Prefix):
+      return NotImplemented
+    return (self.version, self.value, self.prefixlen) < (other.version, other.value, other.prefixlen)
+
+  def __hash__(self):
+    return self._hash
+
+  def __str__(self):
+    return '{}/{}'.format(self.address, self.prefixlen)
+
+  def __repr__(self):
+    return "Prefix('{}')".format(self)
+
+  def to_netaddr(self):
+    return netaddr.IPNetwork(str(self))
+
+# Bounded cache of parsed strings
+_cache = {}
+CACHE_SIZE = 65536
+
+def _parse(text):
+  address, _, length = text.strip().partition('/')
+  try:
+    if ':' in address:
+      version = 6
+      value = int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, address)), 16)
+    else:
+      version = 4
+      value = struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0]
+    return Prefix(version, value, int(length) if length else _widths[version])
+  except (socket.error, ValueError):
+    # Let netaddr handle other notations, or raise its error
+    network = netaddr.IPNetwork(text)
+    return Prefix(network.version, network.first, network.prefixlen)
+
+def parse(network):
+  if isinstance(network, Prefix):
+    return network
+  if isinstance(network, (netaddr.IPNetwork, netaddr.IPAddress)):
+    network = netaddr.IPNetwork(network)
+    return Prefix(network.version, network.first, network.prefixlen)
+
+  prefix = _cache.get(network)
+  if prefix is None:
+    prefix = _parse(str(network))
+    if len(_cache) >= CACHE_SIZE:
+      try:
+        _cache.popitem()
+      except KeyError:
+        pass
+    _cache[network] = prefix
+  return prefix
+
+def supernet(network):
+  # Network one bit shorter, containing network
+  return Prefix(network.version, network.value, network.prefixlen - 1)
+
+def sibling(network):
+  # The other half of the supernet
+  return Prefix(network.version, network.value ^ (1 << (_widths[network.version] - network.prefixlen)), network.prefixlen)
+
+def collapse(networks):
+  # Smallest list of prefixes covering exactly the given networks, sorted
+  result = []
+  for network in sorted(set(networks), key = lambda i: (i.version, i.value, i.prefixlen)):
+    # Sorted order puts supernets before their subnets
+    if result and network in result[-1]:
+      continue
+    result.append(network)
+    # Merge with the sibling half while possible
+    while len(result) > 1:
+      a, b = result[-2], result[-1]
+      if a.version != b.version or a.prefixlen != b.prefixlen or a.prefixlen == 0 or \
+         a.value >> (_widths[a.version] - a.prefixlen + 1) != b.value >> (_widths[b.version] - b.prefixlen + 1):
+        break
+      result[-2:] = [Prefix(a.version, a.value, a.prefixlen - 1)]
+  return result
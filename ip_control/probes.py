@@ -0,0 +1,291 @@
+import os
+import time
+import errno
+import select
+import socket
+import logging
+import threading
+import urlparse
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from ip_control.futures import Future
+
+# Re-resolve probe targets after this many seconds
+RESOLVE_INTERVAL = 300
+
+class Probe(object):
+  socktype = socket.SOCK_STREAM
+
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    self._address = None
+    self._resolved_at = None
+
+  def resolved(self):
+    return self._address is not None and time.time() - self._resolved_at < RESOLVE_INTERVAL
+
+  def resolve(self):
+    family, _, _, _, address = socket.getaddrinfo(self.host, self.port, 0, self.socktype)[0]
+    self._address = (family, address)
+    self._resolved_at = time.time()
+
+  def start(self):
+    family, address = self._address
+    sock = socket.socket(family, self.socktype)
+    sock.setblocking(0)
+    error = sock.connect_ex(address)
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      sock.close()
+      raise socket.error(error, os.strerror(error))
+    return self._run(sock)
+
+  def _run(self, sock):
+    raise NotImplementedError
+
+  def __str__(self):
+    return '{}://{}:{}'.format(self.scheme, self.host, self.port)
+
+class ProbeRun(object):
+  def __init__(self, sock):
+    self.socket = sock
+    self.events = select.POLLOUT
+
+  def _connected(self):
+    return self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+
+  def handle(self, events):
+    # Returns None while running, otherwise whether the probe succeeded
+    raise NotImplementedError
+
+class TCPProbe(Probe):
+  scheme = 'tcp'
+
+  def _run(self, sock):
+    return TCPProbeRun(sock)
+
+class TCPProbeRun(ProbeRun):
+  def handle(self, events):
+    return self._connected()
+
+class HTTPProbe(Probe):
+  scheme = 'http'
+
+  def __init__(self, host, port, path, status = None):
+    super(HTTPProbe, self).__init__(host, port)
+    self.path = path
+    self.status = status
+
+  def _run(self, sock):
+    request = "GET {} HTTP/1.0\r\nHost: {}\r\nUser-Agent: ip-control\r\nConnection: close\r\n\r\n".format(self.path, self.host)
+    return HTTPProbeRun(sock, request, self.status)
+
+  def __str__(self):
+    return 'http://{}:{}{}'.format(self.host, self.port, self.path)
+
+class HTTPProbeRun(ProbeRun):
+  def __init__(self, sock, request, status):
+    super(HTTPProbeRun, self).__init__(sock)
+    self._request = request
+    self._response = ''
+    self._status = status
+    self._connecting = True
+
+  def handle(self, events):
+    if self._connecting:
+      if not self._connected():
+        return False
+      self._connecting = False
+
+    if self._request:
+      sent = self.socket.send(self._request)
+      self._request = self._request[sent:]
+      if not self._request:
+        self.events = select.POLLIN
+      return None
+
+    data = self.socket.recv(4096)
+    self._response += data
+    if '\n' not in self._response:
+      # Connection closed before the status line
+      return None if data else False
+    status_line = self._response.split('\n', 1)[0].split()
+    if len(status_line) < 2 or not status_line[0].startswith('HTTP/') or not status_line[1].isdigit():
+      return False
+    status = int(status_line[1])
+    if self._status:
+      return status in self._status
+    return 200 <= status < 400
+
+class DNSProbe(Probe):
+  scheme = 'dns'
+  socktype = socket.SOCK_DGRAM
+
+  def __init__(self, host, port, name, rdtype = 'A'):
+    super(DNSProbe, self).__init__(host, port)
+    self.name = name
+    self.rdtype = dns.rdatatype.from_text(rdtype)
+
+  def _run(self, sock):
+    return DNSProbeRun(sock, dns.message.make_query(self.name, self.rdtype))
+
+  def __str__(self):
+    return 'dns://{}:{}/{}'.format(self.host, self.port, self.name)
+
+class DNSProbeRun(ProbeRun):
+  def __init__(self, sock, query):
+    super(DNSProbeRun, self).__init__(sock)
+    self._query = query
+
+  def handle(self, events):
+    if self.events == select.POLLOUT:
+      self.socket.send(self._query.to_wire())
+      self.events = select.POLLIN
+      return None
+    try:
+      response = dns.message.from_wire(self.socket.recv(65535))
+    except dns.exception.DNSException:
+      return False
+    if not self._query.is_response(response):
+      # Not our answer, keep waiting
+      return None
+    return response.rcode() == dns.rcode.NOERROR and len(response.answer) > 0
+
+def parse_probe(spec, status = None):
+  # Returns a native probe for URL-like specs, None for shell commands
+  spec = spec.strip()
+  if ' ' in spec or '://' not in spec:
+    return None
+  url = urlparse.urlsplit(spec)
+  if url.scheme not in ('tcp', 'http', 'dns') or not url.hostname:
+    return None
+  if url.scheme == 'tcp':
+    if not url.port:
+      raise ValueError("Health check {} has no port specified.".format(spec))
+    return TCPProbe(url.hostname, url.port)
+  if url.scheme == 'http':
+    path = url.path or '/'
+    if url.query:
+      path += '?' + url.query
+    codes = None
+    if status:
+      codes = set(int(i) for i in str(status).split(','))
+    return HTTPProbe(url.hostname, url.port or 80, path, codes)
+  query = urlparse.parse_qs(url.query)
+  name = url.path.lstrip('/')
+  if not name:
+    raise ValueError("Health check {} has no name to query.".format(spec))
+  return DNSProbe(url.hostname, url.port or 53, name, query.get('type', ['A'])[0])
+
+class ProbeLoop(threading.Thread):
+  def __init__(self, *args, **kwargs):
+    super(ProbeLoop, self).__init__(*args, **kwargs)
+    self.daemon = True
+
+    self._lock = threading.Lock()
+    self._new = []
+    self._running = True
+    self._wake_read, self._wake_write = os.pipe()
+
+  def submit(self, probe, timeout):
+    future = Future()
+    self._lock.acquire()
+    try:
+      # The wake pipe is closed once stopped
+      if self._running:
+        self._new.append((probe, timeout, future))
+        os.write(self._wake_write, 'x')
+        return future
+    finally:
+      self._lock.release()
+    future.set_result(False)
+    return future
+
+  def stop(self):
+    self._lock.acquire()
+    try:
+      if self._running:
+        self._running = False
+        os.write(self._wake_write, 'x')
+    finally:
+      self._lock.release()
+
+  def _finish(self, active, poller, fd, result):
+    _, run, future, _ = active.pop(fd)
+    poller.unregister(fd)
+    run.socket.close()
+    future.set_result(result)
+
+  def run(self):
+    poller = select.poll()
+    poller.register(self._wake_read, select.POLLIN)
+    # File descriptor -> (probe, probe run, future, deadline)
+    active = {}
+    while self._running:
+      # Start newly submitted probes
+      self._lock.acquire()
+      new, self._new = self._new, []
+      self._lock.release()
+      for probe, timeout, future in new:
+        try:
+          run = probe.start()
+        except socket.error as e:
+          logging.warning("Health check %s failed: %s", probe, e)
+          future.set_result(False)
+          continue
+        except Exception:
+          # A broken probe must not stop the others
+          logging.exception("Health check %s failed.", probe)
+          future.set_result(False)
+          continue
+        active[run.socket.fileno()] = (probe, run, future, time.time() + timeout)
+        poller.register(run.socket.fileno(), run.events)
+
+      # Wait for events, but not past the nearest deadline
+      timeout = None
+      if active:
+        timeout = max(0, min(i[3] for i in active.values()) - time.time())
+      try:
+        events = poller.poll(timeout * 1000 if timeout is not None else None)
+      except select.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd, event in events:
+        if fd == self._wake_read:
+          os.read(self._wake_read, 4096)
+          continue
+        if fd not in active:
+          continue
+        probe, run = active[fd][:2]
+        try:
+          result = run.handle(event)
+        except socket.error as e:
+          logging.warning("Health check %s failed: %s", probe, e)
+          result = False
+        except Exception:
+          logging.exception("Health check %s failed.", probe)
+          result = False
+        if result is None:
+          poller.modify(fd, run.events)
+        else:
+          self._finish(active, poller, fd, result)
+
+      # Expire probes which took too long
+      now = time.time()
+      for fd in [fd for fd, i in active.items() if i[3] <= now]:
+        logging.warning("Health check %s timed out.", active[fd][0])
+        self._finish(active, poller, fd, False)
+
+    for fd in active.keys():
+      self._finish(active, poller, fd, False)
+    self._lock.acquire()
+    new, self._new = self._new, []
+    os.close(self._wake_read)
+    os.close(self._wake_write)
+    self._lock.release()
+    for probe, timeout, future in new:
+      future.set_result(False)
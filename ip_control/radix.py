@@ -0,0 +1,213 @@
+_widths = {4: 32, 6: 128}
+
+class _Node(object):
+  __slots__ = ('value', 'prefixlen', 'key', 'data', 'occupied', 'children', 'owner')
+
+  def __init__(self, value, prefixlen, owner):
+    self.value = value
+    self.prefixlen = prefixlen
+    self.key = None
+    self.data = None
+    self.occupied = False
+    self.children = [None, None]
+    # Only the trie with this token may change the node
+    self.owner = owner
+
+def _key(network):
+  return network.version, network.value, network.prefixlen
+
+def _bit(value, position, width):
+  return (value >> (width - 1 - position)) & 1
+
+def _covers(node, value, prefixlen, width):
+  if node.prefixlen > prefixlen:
+    return False
+  shift = width - node.prefixlen
+  return (node.value >> shift) == (value >> shift)
+
+def _common(a, b, limit, width):
+  return min(width - (a ^ b).bit_length(), limit)
+
+class PrefixTrie(object):
+  # Path-compressed binary trie keyed by prefix.Prefix networks. Copies
+  # share nodes, which are copied when first changed by either trie.
+  def __init__(self):
+    self._owner = object()
+    self._roots = dict((version, _Node(0, 0, self._owner)) for version in _widths)
+    self._size = 0
+
+  def copy(self):
+    trie = PrefixTrie()
+    trie._roots = dict(self._roots)
+    trie._size = self._size
+    # Shared nodes are not ours anymore
+    self._owner = object()
+    return trie
+
+  def _own(self, node):
+    # Node which may be changed by this trie, linked in place of node by caller
+    if node.owner is self._owner:
+      return node
+    copy = _Node(node.value, node.prefixlen, self._owner)
+    copy.key = node.key
+    copy.data = node.data
+    copy.occupied = node.occupied
+    copy.children = list(node.children)
+    return copy
+
+  def _own_root(self, version):
+    node = self._roots[version] = self._own(self._roots[version])
+    return node
+
+  def _own_child(self, node, bit):
+    child = node.children[bit]
+    if child is not None and child.owner is not self._owner:
+      child = node.children[bit] = self._own(child)
+    return child
+
+  def __len__(self):
+    return self._size
+
+  def _find(self, network):
+    version, value, prefixlen = _key(network)
+    width = _widths[version]
+    node = self._roots[version]
+    while node and _covers(node, value, prefixlen, width):
+      if node.prefixlen == prefixlen:
+        return node
+      node = node.children[_bit(value, node.prefixlen, width)]
+    return None
+
+  def __contains__(self, network):
+    node = self._find(network)
+    return bool(node and node.occupied)
+
+  def get(self, network, default = None):
+    node = self._find(network)
+    return node.data if node and node.occupied else default
+
+  def __getitem__(self, network):
+    node = self._find(network)
+    if not node or not node.occupied:
+      raise KeyError(network)
+    return node.data
+
+  def __setitem__(self, network, data):
+    version, value, prefixlen = _key(network)
+    width = _widths[version]
+    node = self._own_root(version)
+    while True:
+      if node.prefixlen == prefixlen:
+        break
+      bit = _bit(value, node.prefixlen, width)
+      child = node.children[bit]
+      if child is None:
+        child = _Node(value, prefixlen, self._owner)
+        node.children[bit] = child
+        node = child
+        break
+      common = _common(child.value, value, min(child.prefixlen, prefixlen), width)
+      if common == child.prefixlen:
+        node = self._own_child(node, bit)
+        continue
+      # Split the edge at the common prefix
+      if common == prefixlen:
+        split = _Node(value, prefixlen, self._owner)
+      else:
+        split = _Node(value >> (width - common) << (width - common), common, self._owner)
+      split.children[_bit(child.value, common, width)] = child
+      node.children[bit] = split
+      node = split
+      if common != prefixlen:
+        node = _Node(value, prefixlen, self._owner)
+        split.children[_bit(value, common, width)] = node
+      break
+
+    if not node.occupied:
+      self._size += 1
+    node.key = network
+    node.data = data
+    node.occupied = True
+
+  def __delitem__(self, network):
+    version, value, prefixlen = _key(network)
+    width = _widths[version]
+    if network not in self:
+      raise KeyError(network)
+    path = []
+    node = self._own_root(version)
+    while node.prefixlen < prefixlen:
+      path.append(node)
+      node = self._own_child(node, _bit(value, node.prefixlen, width))
+
+    # Readers of this trie may run meanwhile
+    node.occupied = False
+    node.key = node.data = None
+    self._size -= 1
+
+    # Remove nodes which do not carry data nor branch
+    while path and not node.occupied:
+      parent = path[-1]
+      children = [i for i in node.children if i]
+      if len(children) == 2:
+        break
+      parent.children[parent.children.index(node)] = children[0] if children else None
+      node = path.pop()
+      if not path:
+        break
+
+  def remove(self, network):
+    if network in self:
+      del self[network]
+
+  def longest_match(self, network):
+    # Most specific entry covering network, as (key, data)
+    matches = self.covering(network)
+    return matches[-1] if matches else None
+
+  def covering(self, network):
+    # All entries covering network, from least to most specific
+    version, value, prefixlen = _key(network)
+    width = _widths[version]
+    node = self._roots[version]
+    matches = []
+    while node and _covers(node, value, prefixlen, width):
+      if node.occupied:
+        matches.append((node.key, node.data))
+      if node.prefixlen == prefixlen:
+        break
+      node = node.children[_bit(value, node.prefixlen, width)]
+    return matches
+
+  def _subtree(self, node):
+    stack = [node]
+    while stack:
+      node = stack.pop()
+      if node.occupied:
+        yield node.key, node.data
+      stack.extend(i for i in reversed(node.children) if i)
+
+  def within(self, network):
+    # All entries equal to or more specific than network
+    version, value, prefixlen = _key(network)
+    width = _widths[version]
+    node = self._roots[version]
+    while node and node.prefixlen < prefixlen:
+      if not _covers(node, value, node.prefixlen, width):
+        return iter(())
+      node = node.children[_bit(value, node.prefixlen, width)]
+    if not node:
+      return iter(())
+    # First node at or below the requested length has to be inside it
+    shift = width - prefixlen
+    if (node.value >> shift) != (value >> shift):
+      return iter(())
+    return self._subtree(node)
+
+  def items(self):
+    for root in self._roots.values():
+      for item in self._subtree(root):
+        yield item
+
+  def keys(self):
+    return [i[0] for i in self.items()]
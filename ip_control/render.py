@@ -0,0 +1,275 @@
+import bisect
+import hashlib
+import os
+import os.path
+import tempfile
+from datetime import datetime
+from ip_control.prefix import Prefix, collapse, sibling, supernet
+
+_header = "# Generated by ip-control at {}. Do not touch this file!\n"
+
+def digest(body):
+  return hashlib.sha1(body).hexdigest()
+
+def read_digest(path):
+  # Digest of a previously generated file, without its header
+  try:
+    f = open(path, 'r')
+  except IOError:
+    return None
+  content = f.read()
+  f.close()
+  if content.startswith('# Generated by ip-control'):
+    content = content.split('\n', 1)[1] if '\n' in content else ''
+  return digest(content)
+
+def atomic_write(path, body, header = True):
+  # Write into a temporary file next to the target and rename it over, so
+  # readers always see either the old or the new content
+  directory = os.path.dirname(path) or '.'
+  fd, tmp_path = tempfile.mkstemp(prefix = '.' + os.path.basename(path) + '.', dir = directory)
+  try:
+    output = os.fdopen(fd, 'w')
+    try:
+      if header:
+        output.write(_header.format(str(datetime.now())))
+      output.write(body)
+      output.flush()
+      os.fsync(output.fileno())
+    finally:
+      output.close()
+    os.chmod(tmp_path, os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o644)
+    os.rename(tmp_path, path)
+  except:
+    if os.path.exists(tmp_path):
+      os.unlink(tmp_path)
+    raise
+
+  # Make the rename itself durable
+  try:
+    dir_fd = os.open(directory, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(dir_fd)
+  except OSError:
+    pass
+  finally:
+    os.close(dir_fd)
+
+def _key(network):
+  # Plain tuples sort without calling back into Python
+  return network.version, network.value, network.prefixlen
+
+def _sort_key(network, interface):
+  return _key(network) + (interface,)
+
+def _within(keys, network):
+  # Bounds of sorted keys with addresses inside network, of any length
+  return (bisect.bisect_left(keys, (network.version, network.first)),
+          bisect.bisect_right(keys, (network.version, network.last, 128)))
+
+class _Aggregation(object):
+  # Members of one aggregated interface and the smallest set of prefixes
+  # covering exactly them, both as sorted keys. Changes only touch the
+  # aggregates around changed networks.
+  def __init__(self, interface):
+    self.interface = interface
+    self.members = []
+    self.aggregates = []
+    # Member key -> (network, its line in the announcement)
+    self._listed = {}
+
+  def __len__(self):
+    return len(self.members)
+
+  def _list(self, network):
+    self._listed[_key(network)] = (network, '# enabled {}'.format(network))
+
+  def update(self, add, remove):
+    # Returns keys of aggregates which were added, removed or got other
+    # members
+    if len(add) + len(remove) > len(self.members) / 16:
+      # Collapse everything at once
+      touched = set(self.aggregates)
+      for network in remove:
+        del self._listed[_key(network)]
+      for network in add:
+        self._list(network)
+      self.members = sorted(self._listed)
+      self.aggregates = [_key(i) for i in collapse(self._listed[i][0] for i in self.members)]
+      touched.update(self.aggregates)
+      return touched
+    touched = set([])
+    for network in remove:
+      self._remove(network, touched)
+    for network in add:
+      self._add(network, touched)
+    return touched
+
+  def _covering(self, network):
+    # Aggregate covering network, they do not overlap
+    i = bisect.bisect_right(self.aggregates, _key(network)) - 1
+    if i >= 0:
+      aggregate = Prefix(*self.aggregates[i])
+      if network in aggregate:
+        return aggregate
+    return None
+
+  def _insert(self, network, touched):
+    bisect.insort(self.aggregates, _key(network))
+    touched.add(_key(network))
+
+  def _delete(self, network, touched):
+    i = bisect.bisect_left(self.aggregates, _key(network))
+    if i < len(self.aggregates) and self.aggregates[i] == _key(network):
+      del self.aggregates[i]
+      touched.add(_key(network))
+      return True
+    return False
+
+  def _add(self, network, touched):
+    bisect.insort(self.members, _key(network))
+    self._list(network)
+    aggregate = self._covering(network)
+    if aggregate:
+      touched.add(_key(aggregate))
+      return
+    # New aggregate replaces the ones inside and merges with its siblings
+    lo, hi = _within(self.aggregates, network)
+    touched.update(self.aggregates[lo:hi])
+    del self.aggregates[lo:hi]
+    while network.prefixlen and self._delete(sibling(network), touched):
+      network = supernet(network)
+    self._insert(network, touched)
+
+  def _remove(self, network, touched):
+    del self.members[bisect.bisect_left(self.members, _key(network))]
+    del self._listed[_key(network)]
+    aggregate = self._covering(network)
+    touched.add(_key(aggregate))
+    # Nothing changes if other members still cover the network
+    covering = network
+    while covering.prefixlen:
+      covering = supernet(covering)
+      if _key(covering) in self._listed:
+        return
+    lo, hi = _within(self.members, network)
+    inner = collapse(self._listed[i][0] for i in self.members[lo:hi])
+    if inner == [network]:
+      return
+    # Split the aggregate, siblings on the way up to it stay covered
+    self._delete(aggregate, touched)
+    for i in inner:
+      self._insert(i, touched)
+    while network != aggregate:
+      self._insert(sibling(network), touched)
+      network = supernet(network)
+
+  def lines(self, key):
+    # Lines of an aggregate, or None if it is not one anymore
+    i = bisect.bisect_left(self.aggregates, key)
+    if i == len(self.aggregates) or self.aggregates[i] != key:
+      return None
+    # Announce merged networks, listing their members for loading them back
+    aggregate = Prefix(*key)
+    lo, hi = _within(self.members, aggregate)
+    if self.members[lo:hi] == [key]:
+      announcement = 'stubnet {};'.format(aggregate)
+    else:
+      announcement = "\n".join([self._listed[j][1] for j in self.members[lo:hi]] +
+                               ['stubnet {}; # aggregate of {} networks'.format(aggregate, hi - lo)])
+    return announcement, 'route {} via "{}";'.format(aggregate, self.interface)
+
+class ConfigRenderer(object):
+  # Keeps rendered lines in the order of their networks and updates them
+  # with changes since the previous render
+  def __init__(self):
+    self._networks = frozenset()
+    # Network -> interface it was rendered for
+    self._interfaces = {}
+    # Sort key -> (announcement, route), the sorted keys and their lines
+    self._lines = {}
+    self._order = []
+    self._announcements = []
+    self._routes = []
+    # Interface -> aggregation of its networks, for aggregated interfaces
+    self._aggregations = {}
+    self._rendered = ('', '')
+
+  def render(self, networks, get_interface, aggregate = None, relocated = ()):
+    # Render networks in a stable order. Networks on interfaces for which
+    # aggregate(interface) is true are merged into the smallest set of
+    # covering prefixes. Only networks added or removed since the previous
+    # render are looked up, and relocated ones, whose interface may have
+    # changed.
+    changes = [(network, self._interfaces.pop(network), None) for network in self._networks - networks]
+    added = networks - self._networks
+    for network in added:
+      changes.append((network, None, get_interface(network)))
+    for network in relocated:
+      if network in networks and network not in added:
+        interface = get_interface(network)
+        if interface != self._interfaces[network]:
+          changes.append((network, self._interfaces[network], interface))
+    self._networks = networks
+    if not changes:
+      return self._rendered
+
+    drop = set([])
+    insert = {}
+    # Interface -> (added, removed) members of aggregated interfaces
+    groups = {}
+    for network, previous, interface in changes:
+      if previous is not None:
+        if aggregate and aggregate(previous):
+          groups.setdefault(previous, ([], []))[1].append(network)
+        else:
+          drop.add(_sort_key(network, previous))
+      if interface is not None:
+        self._interfaces[network] = interface
+        if aggregate and aggregate(interface):
+          groups.setdefault(interface, ([], []))[0].append(network)
+        else:
+          insert[_sort_key(network, interface)] = ('stubnet {};'.format(network), 'route {} via "{}";'.format(network, interface))
+
+    # Render again only aggregates around changed networks
+    for interface, (add, remove) in groups.items():
+      aggregation = self._aggregations.get(interface)
+      if aggregation is None:
+        aggregation = self._aggregations[interface] = _Aggregation(interface)
+      for key in aggregation.update(add, remove):
+        lines = aggregation.lines(key)
+        key += (interface,)
+        if key in self._lines:
+          drop.add(key)
+        if lines:
+          insert[key] = lines
+      if not aggregation:
+        del self._aggregations[interface]
+
+    # Lines replaced under the same key keep their place
+    drop.difference_update(insert)
+    for key in drop:
+      del self._lines[key]
+    if len(drop) + len(insert) > len(self._order) / 16:
+      self._lines.update(insert)
+      self._order = sorted(self._lines)
+      self._announcements = [self._lines[key][0] for key in self._order]
+      self._routes = [self._lines[key][1] for key in self._order]
+    else:
+      for key in drop:
+        i = bisect.bisect_left(self._order, key)
+        del self._order[i], self._announcements[i], self._routes[i]
+      for key, lines in insert.items():
+        i = bisect.bisect_left(self._order, key)
+        if key in self._lines:
+          self._announcements[i], self._routes[i] = lines
+        else:
+          self._order.insert(i, key)
+          self._announcements.insert(i, lines[0])
+          self._routes.insert(i, lines[1])
+        self._lines[key] = lines
+
+    self._rendered = ("\n".join(self._announcements), "\n".join(self._routes))
+    return self._rendered
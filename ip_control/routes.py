@@ -0,0 +1,301 @@
+import os
+import time
+import errno
+import socket
+import struct
+import logging
+import binascii
+import threading
+from ip_control import metrics
+from ip_control.prefix import Prefix
+
+_reconcile_seconds = metrics.registry.histogram('route_reconcile_seconds', 'Duration of kernel route reconciliation.', ['family'])
+_changes = metrics.registry.counter('route_changes_total', 'Kernel routes changed by reconciliation.', ['family', 'action', 'outcome'])
+
+class RouteError(Exception):
+  pass
+
+def interface_indexes():
+  # Interface name -> index, from sysfs
+  indexes = {}
+  for name in os.listdir('/sys/class/net'):
+    try:
+      indexes[name] = int(open('/sys/class/net/{}/ifindex'.format(name)).read())
+    except (IOError, ValueError):
+      pass
+  return indexes
+
+_exists = "Route exists already, not of route_protocol"
+
+class FakeBackend(object):
+  # Kernel routes kept in memory, for tests without root
+  def __init__(self, **kwargs):
+    self.routes = {4: {}, 6: {}}
+    self.batches = []
+    self.fail = set([])
+    # Routes of other protocols, they are never replaced
+    self.foreign = {4: {}, 6: {}}
+
+  def dump(self, version):
+    return dict(self.routes[version])
+
+  def apply(self, version, add, remove, replace = ()):
+    # add: network -> interface, remove: networks, replace: added networks
+    # which have a route of ours already
+    self.batches.append((version, dict(add), list(remove)))
+    errors = {}
+    for network in remove:
+      self.routes[version].pop(network, None)
+    for network, interface in add.items():
+      if interface in self.fail:
+        errors[network] = 'No such device'
+        continue
+      if network in self.foreign[version] or (network in self.routes[version] and network not in replace):
+        errors[network] = _exists
+        continue
+      self.routes[version][network] = interface
+    return errors
+
+# rtnetlink constants from linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTA_DST = 1
+RTA_OIF = 4
+RTA_TABLE = 15
+RTN_UNICAST = 1
+RT_SCOPE_LINK = 253
+
+_nlmsghdr = struct.Struct('=LHHLL')
+_rtmsg = struct.Struct('=BBBBBBBBI')
+_rtattr = struct.Struct('=HH')
+_nlmsgerr = struct.Struct('=i')
+_families = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+def _align(length):
+  return (length + 3) & ~3
+
+def _attribute(kind, payload):
+  length = _rtattr.size + len(payload)
+  return _rtattr.pack(length, kind) + payload + '\0' * (_align(length) - length)
+
+def _attributes(data):
+  attributes = {}
+  offset = 0
+  while offset + _rtattr.size <= len(data):
+    length, kind = _rtattr.unpack_from(data, offset)
+    if length < _rtattr.size:
+      break
+    attributes[kind] = data[offset + _rtattr.size:offset + length]
+    offset += _align(length)
+  return attributes
+
+class NetlinkBackend(object):
+  # Routes programmed over rtnetlink. Only routes of our protocol in the
+  # given table are dumped and changed, others are left alone.
+  def __init__(self, protocol = 211, table = 254, batch_size = 65536, batch_messages = 64, timeout = 5):
+    self.protocol = protocol
+    self.table = table
+    self.batch_size = batch_size
+    # Acknowledgements of one write have to fit the receive buffer, each
+    # takes far more of it than its size
+    self.batch_messages = batch_messages
+    self.timeout = timeout
+    self._seq = int(time.time())
+
+  def _socket(self):
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    # A lost reply must not block reconciliation forever
+    sock.settimeout(self.timeout)
+    sock.bind((0, 0))
+    return sock
+
+  def _message(self, kind, flags, body):
+    self._seq += 1
+    return self._seq, _nlmsghdr.pack(_nlmsghdr.size + len(body), kind, flags, self._seq, 0) + body
+
+  def _messages(self, sock):
+    # Messages of one read
+    try:
+      data = sock.recv(1 << 20)
+    except socket.timeout:
+      raise RouteError("No reply from kernel in {} seconds.".format(self.timeout))
+    offset = 0
+    while offset + _nlmsghdr.size <= len(data):
+      length, kind, flags, seq, _ = _nlmsghdr.unpack_from(data, offset)
+      if length < _nlmsghdr.size:
+        raise RouteError("Malformed netlink message.")
+      yield kind, flags, seq, data[offset + _nlmsghdr.size:offset + length]
+      offset += _align(length)
+
+  def dump(self, version):
+    names = dict((index, name) for name, index in interface_indexes().items())
+    width = 4 if version == 4 else 16
+    routes = {}
+    sock = self._socket()
+    try:
+      seq, message = self._message(RTM_GETROUTE, NLM_F_REQUEST | NLM_F_DUMP, _rtmsg.pack(_families[version], 0, 0, 0, 0, 0, 0, 0, 0))
+      sock.send(message)
+      done = False
+      while not done:
+        for kind, flags, reply_seq, body in self._messages(sock):
+          if reply_seq != seq:
+            continue
+          if kind == NLMSG_DONE:
+            done = True
+            break
+          if kind == NLMSG_ERROR:
+            code = _nlmsgerr.unpack_from(body)[0]
+            raise RouteError("Cannot dump routes: {}".format(os.strerror(-code)))
+          family, dst_len, _, _, table, protocol, _, route_type, _ = _rtmsg.unpack_from(body)
+          attributes = _attributes(body[_rtmsg.size:])
+          if RTA_TABLE in attributes:
+            table = struct.unpack('=I', attributes[RTA_TABLE])[0]
+          if table != self.table or protocol != self.protocol or route_type != RTN_UNICAST:
+            continue
+          value = int(binascii.hexlify(attributes.get(RTA_DST, '\0' * width)), 16)
+          oif = struct.unpack('=I', attributes[RTA_OIF])[0] if RTA_OIF in attributes else None
+          routes[Prefix(version, value, dst_len)] = names.get(oif)
+    finally:
+      sock.close()
+    return routes
+
+  def _route(self, kind, flags, network, index = None):
+    address = binascii.unhexlify('%0*x' % (8 if network.version == 4 else 32, network.value))
+    body = _rtmsg.pack(_families[network.version], network.prefixlen, 0, 0, min(self.table, 255), self.protocol, RT_SCOPE_LINK, RTN_UNICAST, 0)
+    body += _attribute(RTA_DST, address) + _attribute(RTA_TABLE, struct.pack('=I', self.table))
+    if index is not None:
+      body += _attribute(RTA_OIF, struct.pack('=I', index))
+    return self._message(kind, flags, body)
+
+  def apply(self, version, add, remove, replace = ()):
+    # All changes are sent in as few writes as possible, the kernel
+    # acknowledges each of them. Returns network -> error message. Only
+    # routes in replace, which dump() returned as ours, are replaced, other
+    # existing routes for added networks are errors.
+    indexes = interface_indexes()
+    replace = frozenset(replace)
+    errors = {}
+    messages = []
+    for network in remove:
+      messages.append((network,) + self._route(RTM_DELROUTE, NLM_F_REQUEST | NLM_F_ACK, network))
+    for network, interface in add.items():
+      if interface not in indexes:
+        errors[network] = "No interface {}".format(interface)
+        continue
+      flags = NLM_F_REPLACE if network in replace else NLM_F_EXCL
+      messages.append((network,) + self._route(RTM_NEWROUTE, NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | flags, network, indexes[interface]))
+
+    sock = self._socket()
+    try:
+      while messages:
+        # Fill one write, then collect its acknowledgements
+        batch, size = {}, 0
+        buffer = []
+        while messages and (not buffer or (size + len(messages[0][2]) <= self.batch_size and len(buffer) < self.batch_messages)):
+          network, seq, message = messages.pop(0)
+          batch[seq] = network
+          buffer.append(message)
+          size += len(message)
+        sock.send(''.join(buffer))
+        while batch:
+          for kind, flags, seq, body in self._messages(sock):
+            if kind != NLMSG_ERROR or seq not in batch:
+              continue
+            network = batch.pop(seq)
+            code = _nlmsgerr.unpack_from(body)[0]
+            # Deleting a route which is gone already is fine
+            if code == -errno.EEXIST and network in add:
+              errors[network] = _exists
+            elif code and not (code == -errno.ESRCH and network in remove):
+              errors[network] = os.strerror(-code)
+    finally:
+      sock.close()
+    return errors
+
+BACKENDS = {
+  'netlink': NetlinkBackend,
+  'fake': FakeBackend
+}
+
+def backend(name, **kwargs):
+  if name not in BACKENDS:
+    raise ValueError("Unknown route backend {}.".format(name))
+  return BACKENDS[name](**kwargs)
+
+class RouteReconciler(threading.Thread):
+  # Keeps kernel routes equal to enabled networks of the Birds, after every
+  # change and periodically to repair drift
+  def __init__(self, backend, birds, interval = 30, *args, **kwargs):
+    super(RouteReconciler, self).__init__(*args, **kwargs)
+    self.daemon = True
+    self.name = 'routes'
+    self.backend = backend
+    # Callable returning version -> BirdConfig
+    self._birds = birds
+    self._interval = interval
+    self._dirty = True
+    self._lock = threading.Condition()
+    self._running = True
+
+  def wake(self):
+    self._lock.acquire()
+    self._dirty = True
+    self._lock.notify()
+    self._lock.release()
+
+  def stop(self):
+    self._lock.acquire()
+    self._running = False
+    self._lock.notify()
+    self._lock.release()
+
+  def reconcile(self):
+    changed = 0
+    for version, bird in sorted(self._birds().items()):
+      with _reconcile_seconds.time(family = version):
+        desired = bird.routes()
+        current = self.backend.dump(version)
+        add = dict((network, interface) for network, interface in desired.items() if current.get(network, False) != interface)
+        remove = [network for network in current if network not in desired]
+        if not (add or remove):
+          continue
+        logging.info("Reconciling IPv%d routes, adding %d and removing %d.", version, len(add), len(remove))
+        # Routes of ours on another interface are replaced, others never
+        errors = self.backend.apply(version, add, remove, [network for network in add if network in current])
+      for network, error in errors.items():
+        logging.error("Cannot %s route %s: %s", 'remove' if network in remove else 'add', network, error)
+      for action, networks in (('add', add), ('remove', remove)):
+        failed = len([i for i in networks if i in errors])
+        _changes.inc(len(networks) - failed, family = version, action = action, outcome = 'ok')
+        if failed:
+          _changes.inc(failed, family = version, action = action, outcome = 'error')
+      changed += len(add) + len(remove) - len(errors)
+    return changed
+
+  def run(self):
+    self._lock.acquire()
+    while self._running:
+      if not self._dirty:
+        self._lock.wait(self._interval)
+      if not self._running:
+        break
+      self._dirty = False
+      self._lock.release()
+      try:
+        self.reconcile()
+      except Exception:
+        logging.exception("Route reconciliation failed.")
+      self._lock.acquire()
+    self._lock.release()
@@ -1,19 +1,83 @@
 import logging
 import logging.config
+import dns.exception
 import dns.resolver
 import dns.reversename
-import netaddr
-import jsonrpclib
+import os
+import os.path
 import subprocess
-from ip_control.bird import BirdConfig, HealthCheckDaemon
+import threading
+import time
+from ip_control import dnscache, metrics, prefix, routes
+from ip_control.bird import BirdConfig
+from ip_control.changelog import Changelog
+from ip_control.ownership import OwnershipTable, Replicator
+from ip_control.peers import PeerPool
+from ip_control.pool import WorkerPool
+from ip_control.radix import PrefixTrie
+from ip_control.healthcheck import HealthCheckDaemon
+
+# Data of the request being served by the current thread
+request_context = threading.local()
+
+# Longest time a watch request is parked
+WATCH_MAX_TIMEOUT = 300
+# Longest time a request waits for BIRD to be written and reloaded
+SAVE_WAIT_TIMEOUT = 60
+# General options read only on start, changing them needs a restart
+RESTART_OPTIONS = frozenset(['peer_timeout', 'peer_workers', 'replicate_ownership', 'ownership_sync_interval',
+                             'route_backend', 'route_protocol', 'route_table', 'route_reconcile_interval',
+                             'rpc_workers', 'rpc_max_connections', 'metrics_port', 'metrics_address', 'persistance_file'])
+# General options applied on reconfiguration or read when used, no need to
+# configure again
+LIVE_OPTIONS = frozenset(['dns_cache_size', 'dns_negative_ttl', 'dns_stale_grace', 'dns_timeout', 'dns_workers'])
 
 class RPC(object):
+  # Methods which do not change any state, private so clients cannot change it
+  _read_only = frozenset(['status', 'status_many', 'list_enabled', 'find_section', 'stats', 'owner', 'ownership_digest', 'watch', 'dampening'])
+
   def __init__(self, (bind_ip, bind_port)):
+    from ip_control.configuration import config
+
     self.bind_ip = bind_ip
     self.bind_port = bind_port
+    self._owner_id = prefix.parse(bind_ip).address
     self._health_checks = None
+    self._bird = {}
+    # Changes of both families, kept over reconfiguration
+    self._changelog = Changelog()
+    self._peers = PeerPool(bind_port,
+                           timeout = config.getfloat('General', 'peer_timeout') if config.has_option('General', 'peer_timeout') else 5,
+                           workers = config.getint('General', 'peer_workers') if config.has_option('General', 'peer_workers') else 16,
+                           source_ip = bind_ip)
+
+    # Replicated table of unicast network owners
+    self._ownership = None
+    self._replicator = None
+    if config.has_option('General', 'replicate_ownership') and config.getboolean('General', 'replicate_ownership'):
+      self._ownership = OwnershipTable()
+      self._replicator = Replicator(self._ownership, self._peers, self._controllers, self._ownership_merged,
+                                    interval = config.getfloat('General', 'ownership_sync_interval') if config.has_option('General', 'ownership_sync_interval') else 60)
+
+    # Kernel routes of enabled networks, programmed directly
+    self._routes = None
+    if config.has_option('General', 'route_backend'):
+      backend = routes.backend(config.get('General', 'route_backend'),
+                               protocol = config.getint('General', 'route_protocol') if config.has_option('General', 'route_protocol') else 211,
+                               table = config.getint('General', 'route_table') if config.has_option('General', 'route_table') else 254)
+      self._routes = routes.RouteReconciler(backend, lambda: self._bird,
+                                            interval = config.getfloat('General', 'route_reconcile_interval') if config.has_option('General', 'route_reconcile_interval') else 30)
+      self._changelog.subscribe(self._routes.wake)
 
-    self.configure()
+    self._configure()
+    if self._replicator:
+      self._replicator.start()
+    if self._routes:
+      self._routes.start()
+
+  @property
+  def client_address(self):
+    return getattr(request_context, 'client_address', None)
 
   def _controllers(self, only_ip = False):
     from configuration import config
@@ -21,158 +85,490 @@ class RPC(object):
     controllers = []
     if config.has_option('General', 'ip_control_dns_name'):
       control_domain = config.get('General', 'ip_control_dns_name')
-      self_ip = netaddr.IPNetwork(self.bind_ip)
-      for answer in dns.resolver.query(control_domain, 'A'):
-        ip = netaddr.IPNetwork(answer.to_text())
+      self_ip = prefix.parse(self.bind_ip)
+      for answer in dnscache.query(control_domain, 'A'):
+        ip = prefix.parse(answer.to_text())
         if ip == self_ip:
           # Ignore itself
           continue
-        ip = ip.ip
-        if not only_ip:
-          try:
-            controllers.append(jsonrpclib.Server("http://{}:{}/".format(ip, self.bind_port)))
-          except:
-            logging.warning("Could not connect to controller %s.", ip)
-        else:
-          controllers.append(ip)
+        controllers.append(ip.address)
+    if not only_ip:
+      self._peers.prune(controllers)
+      controllers = [self._peers.get(i) for i in controllers]
     return controllers
 
-  def configure(self):
-    import os.path
+  def _existing_interfaces(self, names):
+    # Read all interfaces at once if sysfs is available
+    if os.path.isdir('/sys/class/net'):
+      existing = set(os.listdir('/sys/class/net'))
+      return set(i for i in names if i in existing)
+    return set(i for i in names if not subprocess.call(['/sbin/ifconfig', i]))
+
+  def _allowed_hosts(self, section):
+    from ip_control.configuration import config
+
+    if not config.has_option(section, 'allowed_hosts'):
+      return set([])
+    allowed_hosts = [i.strip() for i in config.get(section, 'allowed_hosts').split(',')]
+    return set([i if i.endswith('.') else i + '.' for i in allowed_hosts])
+
+  def _validate_host(self, host):
+    try:
+      address = dnscache.query(host)
+      if len(address) > 1:
+        logging.warning("Host %s resolves to multiple IP addresses, removing from allowed hosts.", host)
+        return False
+      address = address[0]
+      logging.info("Host %s resolved to %s", host, address)
+    except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+      logging.warning("Host %s has no DNS record, removing it from allowed hosts.", host)
+      return False
+    except dns.exception.DNSException as e:
+      logging.warning("Cannot resolve host %s (%s), removing it from allowed hosts.", host, e)
+      return False
+    # Check reverse lookup
+    try:
+      reverse_lookup = dnscache.query(dns.reversename.from_address(address.to_text()), 'PTR')
+      if len(reverse_lookup) > 1:
+        logging.warning("Host's %s IP %s has many reverse records, removing it from allowed hosts.", host, address)
+        return False
+      reverse_lookup = reverse_lookup[0].to_text()
+      logging.info("Resolved IP %s has an inverse record to %s", address, reverse_lookup)
+    except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+      logging.warning("Host's %s IP %s has no reverse DNS record, removing it from allowed hosts.", host, address)
+      return False
+    except dns.exception.DNSException as e:
+      logging.warning("Cannot resolve reverse record of host's %s IP %s (%s), removing it from allowed hosts.", host, address, e)
+      return False
+    # Does host and reversed looked up host match?
+    if host != reverse_lookup:
+      logging.warning("Host %s and it's reverse %s from IP %s does not match, removing it from allowed hosts.", host, reverse_lookup, address)
+      return False
+    logging.info("Host's %s DNS records are properly configured.", host)
+    return True
+
+  def _validate_hosts(self, hosts):
+    from ip_control.configuration import config
+
+    # Check hosts in parallel, every host only once
+    if not hosts:
+      return set([])
+    pool = WorkerPool(config.getint('General', 'dns_workers') if config.has_option('General', 'dns_workers') else 16, name = 'validate-host')
+    try:
+      futures = [(host, pool.submit(self._validate_host, host)) for host in hosts]
+      return set(host for host, future in futures if future.result())
+    finally:
+      pool.shutdown()
+
+  def _section_items(self, section):
+    from ip_control.configuration import config
+    return dict(config.items(section))
+
+  def _network_sections(self):
+    # Options of all network sections as read, without defaults. They are
+    # compared with dict.__eq__, OrderedDict would compare them in Python.
+    from ip_control.configuration import config
+    return dict((i, options) for i, options in config._sections.items() if i != 'General')
+
+  def _option_changed(self, section, sections, option):
+    return sections[section].get(option) != self._sections[section].get(option)
+
+  def _health_check_changed(self, section, sections):
+    options = set(i for i in sections[section].keys() + self._sections[section].keys() if i.startswith('health_check'))
+    return any(self._option_changed(section, sections, i) for i in options | set(['unicast']))
+
+  def _load_section(self, section, networks, interfaces, valid_hosts, health_check = True):
+    from ip_control.configuration import config
+
+    network = prefix.parse(section)
+    logging.info('Loading network %s.', network)
+    # Check for interface
+    if not config.has_option(section, 'interface'):
+      logging.warning("Network %s has no interface specified, ignoring it.", network)
+      return False
+    interface = config.get(section, 'interface')
+    # Check if interface exists
+    if interface not in interfaces:
+      logging.warning("Interface %s does not exists, ignoring network %s.", interface, network)
+      return False
+
+    # Add network
+    networks[network] = {
+      'allowed_hosts': self._allowed_hosts(section) & valid_hosts,
+      'unique': config.getboolean(section, 'unicast') if config.has_option(section, 'unicast') else True
+    }
+
+    # Setup health check
+    if health_check and config.has_option(section, 'health_check'):
+      logging.info("Network %s has health check specified, chekcking compatibility with other options.", network)
+      if networks[network]['unique']:
+        logging.warning("Network %s is specified as a unicast IP, ignoring health check.", network)
+      else:
+        logging.info("Enabling health check for network %s.", network)
+        try:
+          self._health_checks[network.version].add_network(network, config.get(section, 'health_check'), **self._health_check_options(section))
+        except ValueError as e:
+          logging.warning("Invalid health check for network %s, ignoring it: %s", network, e)
+    return True
+
+  def _remove_obsolete(self, within = None):
+    # Disable enabled networks which are not configured anymore, only those
+    # within given networks if any
+    changed = set([])
+    for version, bird in self._bird.items():
+      if within is None:
+        candidates = bird.networks
+      else:
+        candidates = set(i for network in within if network.version == version for i in bird.networks_within(network))
+      obsolete = [i for i in candidates if not self._network_config(i)]
+      for network in obsolete:
+        logging.info('Removing obsolete network %s.', network)
+      if bird.update(remove = obsolete):
+        changed.add(bird)
+    return changed
+
+  def _configure(self):
     from ip_control.configuration import config
     logging.info("Configuring")
+    # Time of finishing each phase, for reporting
+    phases = [(None, time.time())]
+
+    # Stop previous health checks and flush pending changes of previous Birds
+    self._close()
 
     # Initialize Birds
     self._bird = {
-      4: BirdConfig(4),
-      6: BirdConfig(6)
+      4: BirdConfig(4, self._changelog),
+      6: BirdConfig(6, self._changelog)
     }
     # (Re-)Initialize health checks
-    if self._health_checks:
-      self._health_checks[4].stop()
-      self._health_checks[6].stop()
+    workers = config.getint('General', 'health_check_workers') if config.has_option('General', 'health_check_workers') else 8
+    jitter = config.getfloat('General', 'health_check_jitter') if config.has_option('General', 'health_check_jitter') else 0.1
     self._health_checks = {
-      4: HealthCheckDaemon(self._bird[4]),
-      6: HealthCheckDaemon(self._bird[6])
+      4: HealthCheckDaemon(self._bird[4], workers = workers, jitter = jitter),
+      6: HealthCheckDaemon(self._bird[6], workers = workers, jitter = jitter)
     }
     self._health_checks[4].start()
     self._health_checks[6].start()
+    phases.append(('birds', time.time()))
+
+    # Check interfaces and allowed hosts of all sections at once
+    sections = [i for i in config.sections() if i != 'General']
+    interfaces = self._existing_interfaces(set(config.get(i, 'interface') for i in sections if config.has_option(i, 'interface')))
+    phases.append(('interfaces', time.time()))
+    valid_hosts = self._validate_hosts(set(host for i in sections for host in self._allowed_hosts(i)))
+    phases.append(('hosts', time.time()))
 
     # Load networks
-    self._networks = {}
-    for section in (i for i in config.sections() if i != 'General'):
-      network = netaddr.IPNetwork(section)
-      logging.info('Loading network %s.', network)
-      # Check for interface
-      if not config.has_option(section, 'interface'):
-        logging.warning("Network %s has no interface specified, ignoring it.", network)
-        continue
-      interface = config.get(section, 'interface')
-      # Check if interface exists
-      if subprocess.call(['/sbin/ifconfig', interface]):
-        logging.warning("Interface %s does not exists, ignoring network %s.", interface, network)
-        continue
-      # Get allowed hosts, also check them if are properly configured
-      if config.has_option(section, 'allowed_hosts'):
-        allowed_hosts = [i.strip() for i in config.get(section, 'allowed_hosts').split(',')]
-        allowed_hosts = set([i if i.endswith('.') else i + '.' for i in allowed_hosts])
-        for host in [i for i in allowed_hosts]:
-          try:
-            address = dns.resolver.query(host)
-            if len(address) > 1:
-              logging.warning("Host %s resolves to multiple IP addresses, removing from allowed hosts.", host)
-              allowed_hosts.remove(host)
-              continue
-            address = address[0]
-            logging.info("Host %s resolved to %s", host, address)
-          except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            logging.warning("Host %s has no DNS record, removing it from allowed hosts.", host)
-            allowed_hosts.remove(host)
-            continue
-          # Check reverse lookup
-          try:
-            reverse_lookup = dns.resolver.query(dns.reversename.from_address(address.to_text()), 'PTR')
-            if len(reverse_lookup) > 1:
-              logging.warning("Host's %s IP %s has many reverse records, removing it from allowed hosts.", host, address)
-              allowed_hosts.remove(host)
-              continue
-            reverse_lookup = reverse_lookup[0].to_text()
-            logging.info("Resolved IP %s has an inverse record to %s", address, reverse_lookup)
-          except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            logging.warning("Host's %s IP %s has no reverse DNS record, removing it from allowed hosts.", host, address)
-            allowed_hosts.remove(host)
-            continue
-          # Does host and reversed looked up host match?
-          if host != reverse_lookup:
-            logging.warning("Host %s and it's reverse %s from IP %s does not match, removing it from allowed hosts.", host, reverse_lookup, address)
-            allowed_hosts.remove(host)
-          else:
-            logging.info("Host's %s DNS records are properly configured.", host)
+    networks = PrefixTrie()
+    for section in sections:
+      self._load_section(section, networks, interfaces, valid_hosts)
+    self._networks = networks
+    phases.append(('networks', time.time()))
+
+    # Remove non managed networks (they should not be announced anymore!)
+    for bird in self._remove_obsolete():
+      bird.schedule_save()
+    self._own_enabled()
+    if self._routes:
+      self._routes.wake()
+    phases.append(('cleanup', time.time()))
+
+    # Remember applied configuration for later reconfiguration
+    self._general = self._section_items('General')
+    self._sections = self._network_sections()
+
+    logging.info("Configured %d networks in %.3fs (%s).", len(networks), phases[-1][1] - phases[0][1],
+                 ', '.join('{} {:.3f}s'.format(name, finished - phases[i][1]) for i, (name, finished) in enumerate(phases[1:])))
+
+  def _close(self):
+    # Stop health checks and flush pending changes
+    if self._health_checks:
+      self._health_checks[4].stop()
+      self._health_checks[6].stop()
+    for bird in self._bird.values():
+      bird.close()
+
+  def _reconfigure(self):
+    from ip_control.configuration import config
+
+    general = self._section_items('General')
+    options = set(i for i in set(general) | set(self._general) if general.get(i) != self._general.get(i))
+    if options & RESTART_OPTIONS:
+      logging.warning("Changes of %s take effect only after restart.", ', '.join(sorted(options & RESTART_OPTIONS)))
+    # Other options of General may change Birds or daemons, start over
+    if options - RESTART_OPTIONS - LIVE_OPTIONS:
+      logging.info("General configuration has changed, configuring from scratch.")
+      return self._configure()
+    self._general = general
+
+    started = time.time()
+    sections = self._network_sections()
+    removed = [i for i in self._sections if i not in sections]
+    added = [i for i in sections if i not in self._sections]
+    changed = [i for i in sections if i in self._sections and not dict.__eq__(sections[i], self._sections[i])]
+    if not (removed or added or changed):
+      logging.info("Configuration has not changed.")
+      return
+    logging.info("Reconfiguring %d added, %d changed and %d removed networks.", len(added), len(changed), len(removed))
+
+    # Only check what the changed sections need
+    previous = {}
+    for section in changed:
+      network_config = self._networks.get(prefix.parse(section))
+      if network_config:
+        previous[section] = network_config
+    interfaces = self._existing_interfaces(set(sections[i]['interface'] for i in added + changed if 'interface' in sections[i]))
+    hosts = set([])
+    for section in added + changed:
+      if section not in previous or self._option_changed(section, sections, 'allowed_hosts'):
+        hosts |= self._allowed_hosts(section)
+    valid_hosts = self._validate_hosts(hosts)
+
+    # Work on a copy sharing unchanged nodes, requests keep using the
+    # current table meanwhile
+    networks = self._networks.copy()
+    save = set([])
+    unconfigured = []
+    for section in removed + changed:
+      network = prefix.parse(section)
+      networks.remove(network)
+      unconfigured.append(network)
+      if section in removed or self._health_check_changed(section, sections):
+        self._health_checks[network.version].remove_network(network)
+      if section in removed and self._bird[network.version].remove_interface(network):
+        save.add(self._bird[network.version])
+    for section in added + changed:
+      network = prefix.parse(section)
+      # Hosts of unchanged lists were validated before
+      valid = valid_hosts
+      if section in previous and not self._option_changed(section, sections, 'allowed_hosts'):
+        valid = previous[section]['allowed_hosts']
+      health_check = section not in previous or self._health_check_changed(section, sections)
+      if self._load_section(section, networks, interfaces, valid, health_check):
+        if self._bird[network.version].set_interface(network, sections[section]['interface']):
+          save.add(self._bird[network.version])
       else:
-        allowed_hosts = set([])
+        if not health_check:
+          self._health_checks[network.version].remove_network(network)
+        if self._bird[network.version].remove_interface(network):
+          save.add(self._bird[network.version])
+    self._networks = networks
+    self._sections = sections
 
-      # Add network
-      self._networks[network] = {
-        'allowed_hosts': allowed_hosts,
-        'unique': config.getboolean(section, 'unicast') if config.has_option(section, 'unicast') else True
-      }
+    # Only networks of removed sections may be left without one
+    save |= self._remove_obsolete(unconfigured)
+    for bird in save:
+      bird.schedule_save()
+    # Interfaces of enabled networks may have changed
+    if save and self._routes:
+      self._routes.wake()
+    logging.info("Reconfigured in %.3fs.", time.time() - started)
 
-      # Setup health check
-      if config.has_option(section, 'health_check'):
-        logging.info("Network %s has health check specified, chekcking compatibility with other options.", network)
-        if self._networks[network]['unique']:
-          logging.warning("Network %s is specified as a unicast IP, ignoring health check.", network)
-        else:
-          logging.info("Enabling health check for network %s.", network)
-          self._health_checks[network.version].add_network(network, config.get(section, 'health_check'))
+  def _own_enabled(self):
+    # Unicast networks announced here and not known to the table are ours,
+    # other controllers learn about them on synchronization
+    if not self._ownership:
+      return
+    for bird in self._bird.values():
+      for network in bird.networks:
+        if (self._network_config(network) or {}).get('unique', True) and not self._ownership.get(network):
+          self._ownership.merge(network, (self._owner_id, 0))
 
-    # Remove non managed networks (they should not be announced anymore!)
-    changed = set([])
-    for bird, obsolete_network in ((b, i) for b in self._bird.values() for i in b.networks if i not in self._networks):
-      logging.info('Removing obsolete network %s.', obsolete_network)
-      bird.remove_network(obsolete_network)
-      changed.add(bird)
-    for bird in changed:
-      bird.save()
-
-  def enable(self, network):
-    network = netaddr.IPNetwork(network)
+  def _ownership_merged(self, network, previous, entry):
+    # Another controller has taken over a network announced here
+    if not entry.owner or entry.owner == self._owner_id:
+      return
+    bird = self._bird[network.version]
+    if (self._network_config(network) or {}).get('unique', True) and bird.has_network(network):
+      logging.warning("Controller %s has taken over the network %s, disabling it.", entry.owner, network)
+      bird.remove_network(network)
+      bird.schedule_save()
+
+  def _health_check_options(self, section):
+    from ip_control.configuration import config
+
+    options = {}
+    for option, name, get in (('interval', 'health_check_interval', config.getfloat),
+                              ('timeout', 'health_check_timeout', config.getfloat),
+                              ('rise', 'health_check_rise', config.getint),
+                              ('fall', 'health_check_fall', config.getint),
+                              ('status', 'health_check_status', config.get),
+                              ('dampening', 'health_check_dampening', config.getboolean),
+                              ('half_life', 'health_check_half_life', config.getfloat),
+                              ('flap_penalty', 'health_check_flap_penalty', config.getfloat),
+                              ('suppress', 'health_check_suppress', config.getfloat),
+                              ('reuse', 'health_check_reuse', config.getfloat),
+                              ('max_suppress', 'health_check_max_suppress', config.getfloat)):
+      if config.has_option(section, name):
+        options[option] = get(section, name)
+    return options
+
+  def _disable_elsewhere(self, network, controllers):
+    # Disable this IP over all controllers at once
+    def disable(controller):
+      if controller.call('status', str(network)) == 'enabled':
+        controller.call('disable', str(network))
+        return 'disabled'
+      return 'not enabled'
+
+    summary = {}
+    for controller, (outcome, result) in self._peers.fan_out(controllers, disable).items():
+      if outcome == 'ok':
+        summary[str(controller)] = result
+      elif outcome == 'timeout':
+        logging.warning("Controller %s did not answer in time when disabling the network %s.", controller, network)
+        summary[str(controller)] = 'timeout'
+      else:
+        # Ignore exception, just log it
+        logging.warning("There was an exception when trying to disable the network %s on controller %s: %s", network, controller, result)
+        summary[str(controller)] = 'error: {}'.format(result)
+    return summary
+
+  def _disable_owner(self, network, owner):
+    # Disable this IP on its owner only, None if it did not give it up
+    def disable(controller):
+      controller.call('disable', str(network))
+      return controller.call('status', str(network))
+
+    owner = self._peers.get(owner)
+    outcome, result = self._peers.fan_out([owner], disable)[owner]
+    if outcome == 'ok' and result == 'disabled':
+      return {str(owner): 'disabled'}
+    logging.warning("Owner %s of the network %s did not disable it (%s), asking all controllers.", owner, network, result or outcome)
+    return None
+
+  def _take_over(self, network, controllers):
+    # With a complete ownership table only the owner has to be asked
+    if self._ownership and self._replicator.synced(controllers):
+      entry = self._ownership.get(network)
+      if not entry or entry.owner in (None, self._owner_id):
+        return {}
+      peers = self._disable_owner(network, entry.owner)
+      if peers is not None:
+        return peers
+    return self._disable_elsewhere(network, controllers)
+
+  def _enable(self, network, controllers = None):
     network_config = self._check_access(network)
 
-    if network_config.get('unique', True):
-      # Disable this IP over all controllers
-      for controller in self._controllers():
-        try:
-          if controller.status(str(network)) == 'enabled':
-            controller.disable(str(network))
-        except:
-          # Ignore exception, just log it
-          logging.exception("There was an exception when trying to disable the network %s on controller %s:", network, controller)
+    peers = {}
+    unique = network_config.get('unique', True)
+    if unique:
+      peers = self._take_over(network, controllers if controllers is not None else self._controllers())
+      if self._ownership:
+        entry = self._ownership.get(network)
+        if not entry or entry.owner != self._owner_id:
+          self._replicator.push(network, self._ownership.claim(network, self._owner_id))
 
     if not self._bird[network.version].has_network(network):
       self._bird[network.version].add_network(network)
-      self._bird[network.version].save()
+      return True, peers
+    return False, peers
 
-  def disable(self, network):
-    network = netaddr.IPNetwork(network)
-    self._check_access(network)
+  def _disable(self, network):
+    network_config = self._check_access(network)
 
     if self._bird[network.version].has_network(network):
       self._bird[network.version].remove_network(network)
-      self._bird[network.version].save()
+      if self._ownership and network_config.get('unique', True):
+        entry = self._ownership.get(network)
+        if not entry or entry.owner == self._owner_id:
+          self._replicator.push(network, self._ownership.release(network))
+      return True
+    return False
+
+  def _save(self, versions, wait):
+    # Returns versions which were not written and reloaded, if waiting
+    futures = [(version, self._bird[version].schedule_save()) for version in sorted(versions)]
+    failed = set([])
+    if wait:
+      deadline = time.time() + SAVE_WAIT_TIMEOUT
+      for version, future in futures:
+        try:
+          # Failures of writing or reloading are logged by the Bird
+          if not future.result(max(0, deadline - time.time())):
+            failed.add(version)
+        except Exception as e:
+          logging.error("Saving IPv%d networks failed: %s", version, e)
+          failed.add(version)
+    return failed
+
+  def _apply_many(self, networks, apply, wait):
+    results = {}
+    versions = {}
+    changed = set([])
+    for network in networks:
+      try:
+        parsed = prefix.parse(network)
+        if apply(parsed):
+          changed.add(parsed.version)
+        versions[network] = parsed.version
+        results[network] = self.status(parsed)
+      except Exception as e:
+        logging.warning("Batch change of network %s failed: %s", network, e)
+        results[network] = 'error: {}'.format(e)
+
+    # Save once per address family
+    failed = self._save(changed, wait)
+    for network, version in versions.items():
+      if version in failed:
+        results[network] = 'error: BIRD was not updated, network is {}'.format(results[network])
+    return results
+
+  def enable(self, network, wait = False):
+    network = prefix.parse(network)
+    changed, peers = self._enable(network)
+    failed = self._save([network.version], wait) if changed else set([])
+    result = {
+      'status': self.status(network),
+      'peers': peers
+    }
+    if wait:
+      result['saved'] = not failed
+    return result
+
+  def enable_many(self, networks, wait = False):
+    # Look up other controllers only once per batch
+    controllers = {}
+    def enable(network):
+      if 'all' not in controllers and (self._network_config(network) or {}).get('unique', True):
+        controllers['all'] = self._controllers()
+      return self._enable(network, controllers.get('all'))[0]
+    return self._apply_many(networks, enable, wait)
+
+  def disable(self, network, wait = False):
+    network = prefix.parse(network)
+    failed = self._save([network.version], wait) if self._disable(network) else set([])
+    if wait:
+      return {
+        'status': self.status(network),
+        'saved': not failed
+      }
+
+  def disable_many(self, networks, wait = False):
+    return self._apply_many(networks, self._disable, wait)
+
+  def _network_config(self, network):
+    # Most specific configured section decides the policy
+    match = self._networks.longest_match(network)
+    return match[1] if match else None
+
+  def _from_controller(self):
+    return prefix.parse(self.client_address).address in self._controllers(only_ip = True)
 
   def _check_access(self, network):
-    network_config = self._networks.get(network, None)
+    network_config = self._network_config(network)
     if not network_config:
       raise Exception("Network {} not known at this controller.".format(network))
 
     # Check if controller is connecting to us
-    if netaddr.IPNetwork(self.client_address).ip in self._controllers(only_ip = True):
+    if self._from_controller():
       return network_config
 
     # Resolve IP into host name
     try:
-      client = dns.resolver.query(dns.reversename.from_address(self.client_address), 'PTR')
+      client = dnscache.query(dns.reversename.from_address(self.client_address), 'PTR')
       client = client[0].to_text()
     except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
       logging.error("IP %s has no reverse records.", self.client_address)
@@ -185,5 +581,88 @@ class RPC(object):
     return network_config
 
   def status(self, network):
-    network = netaddr.IPNetwork(network)
+    network = prefix.parse(network)
     return 'enabled' if self._bird[network.version].has_network(network) else 'disabled'
+
+  def status_many(self, networks):
+    results = {}
+    for network in networks:
+      try:
+        results[network] = self.status(network)
+      except Exception as e:
+        results[network] = 'error: {}'.format(e)
+    return results
+
+  def watch(self, networks = None, since_seq = None, timeout = 30):
+    # Changes of networks (all if not given) after since_seq, waits up to
+    # timeout seconds for the first one
+    names = dict((prefix.parse(i), i) for i in networks) if networks else None
+    timeout = max(0, min(float(timeout), WATCH_MAX_TIMEOUT))
+    if since_seq is None:
+      seq, events, reset = self._changelog.seq, [], True
+    else:
+      seq, events, reset = self._changelog.since(int(since_seq), names, timeout)
+
+    result = {
+      'seq': seq,
+      'reset': reset,
+      'events': [{'seq': i.seq, 'network': names[i.network] if names else str(i.network), 'status': i.status} for i in events]
+    }
+    if reset:
+      # Changes were missed, start over from current state
+      if networks:
+        result['status'] = self.status_many(networks)
+      else:
+        result['status'] = dict((str(i), 'enabled') for bird in self._bird.values() for i in bird.networks)
+    return result
+
+  def list_enabled(self, supernet):
+    supernet = prefix.parse(supernet)
+    return [str(i) for i in sorted(self._bird[supernet.version].networks_within(supernet))]
+
+  def find_section(self, address):
+    match = self._networks.longest_match(prefix.parse(address))
+    return str(match[0]) if match else None
+
+  def stats(self):
+    # Counters and latency histograms of this controller
+    return metrics.registry.stats()
+
+  def dampening(self, network = None):
+    # Flap penalty and suppression of a health checked network, or of all
+    # networks with dampening
+    if network is not None:
+      network = prefix.parse(network)
+      return self._health_checks[network.version].dampening(network)
+    states = self._health_checks[4].dampening()
+    states.update(self._health_checks[6].dampening())
+    return states
+
+  def owner(self, network):
+    # Controller announcing an unicast network, as known to this one
+    if not self._ownership:
+      raise Exception("Ownership replication is not enabled.")
+    entry = self._ownership.get(network)
+    return entry.owner if entry else None
+
+  def _check_replication(self):
+    if not self._ownership:
+      raise Exception("Ownership replication is not enabled.")
+    if not self._from_controller():
+      raise Exception("Access denied")
+
+  def ownership_update(self, entries):
+    # Changes pushed by another controller
+    self._check_replication()
+    self._replicator.merge(entries)
+    return True
+
+  def ownership_digest(self):
+    self._check_replication()
+    return self._ownership.digest()
+
+  def ownership_exchange(self, entries):
+    # Anti-entropy, merge table of another controller and send ours back
+    self._check_replication()
+    self._replicator.merge(entries)
+    return self._ownership.to_wire()
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+import jsonrpclib
+from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, \
+                                           SimpleJSONRPCRequestHandler
+from ip_control import metrics
+from ip_control.rpc import request_context
+
+_request_seconds = metrics.registry.histogram('rpc_request_seconds', 'Duration of RPC calls.', ['method'])
+_requests = metrics.registry.counter('rpc_requests_total', 'RPC calls by outcome.', ['method', 'outcome'])
+
+class RequestHandler(SimpleJSONRPCRequestHandler):
+  # Keep connections open for other controllers, close them when idle
+  protocol_version = 'HTTP/1.1'
+  timeout = 30
+  # Send each response at once, small writes would wait for delayed ACKs
+  disable_nagle_algorithm = True
+  wbufsize = -1
+
+  def setup(self):
+    SimpleJSONRPCRequestHandler.setup(self)
+    request_context.client_address = self.client_address[0]
+
+  def do_POST(self):
+    if not self.is_rpc_path_valid():
+      self.report_404()
+      return
+    try:
+      data = self.rfile.read(int(self.headers['content-length']))
+      response = self.server._marshaled_dispatch(data)
+      self.send_response(200)
+    except Exception:
+      logging.exception("Got exception when handling request from %s.", self.client_address[0])
+      self.send_response(500)
+      response = jsonrpclib.Fault(-32603, 'Server error').response()
+    if response is None:
+      response = ''
+    self.send_header("Content-type", "application/json-rpc")
+    self.send_header("Content-length", str(len(response)))
+    self.end_headers()
+    self.wfile.write(response)
+    self.wfile.flush()
+
+class ConcurrentJSONRPCServer(SimpleJSONRPCServer):
+  daemon_threads = True
+
+  def __init__(self, addr, workers = 4, max_connections = 256, **kwargs):
+    # Connections beyond the limit wait in listen backlog
+    self.request_queue_size = max_connections
+    self._connections = threading.BoundedSemaphore(max_connections)
+    self._mutations = threading.BoundedSemaphore(workers)
+    kwargs.setdefault('requestHandler', RequestHandler)
+    SimpleJSONRPCServer.__init__(self, addr, **kwargs)
+
+  def process_request(self, request, client_address):
+    # Stop accepting when all connection slots are taken
+    self._connections.acquire()
+    thread = threading.Thread(target = self._process_request, args = (request, client_address))
+    thread.daemon = self.daemon_threads
+    thread.start()
+
+  def _process_request(self, request, client_address):
+    try:
+      self.finish_request(request, client_address)
+    except:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+      self._connections.release()
+
+  def _dispatch(self, method, params):
+    # Do not let clients create labels for methods which do not exist
+    label = method if not method.startswith('_') and callable(getattr(self.instance, method, None)) else 'unknown'
+    started = time.time()
+    outcome = 'error'
+    try:
+      result = self._dispatch_method(method, params)
+      # Errors come back as faults
+      if not isinstance(result, jsonrpclib.Fault):
+        outcome = 'ok'
+      return result
+    finally:
+      _request_seconds.observe(time.time() - started, method = label)
+      _requests.inc(method = label, outcome = outcome)
+
+  def _dispatch_method(self, method, params):
+    # Read-only calls never wait for mutations
+    if method in getattr(self.instance, '_read_only', ()):
+      return SimpleJSONRPCServer._dispatch(self, method, params)
+    self._mutations.acquire()
+    try:
+      return SimpleJSONRPCServer._dispatch(self, method, params)
+    finally:
+      self._mutations.release()
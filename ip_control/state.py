@@ -0,0 +1,220 @@
+import os
+import os.path
+import struct
+import logging
+import threading
+import zlib
+from ip_control.prefix import Prefix
+from ip_control.render import atomic_write
+
+# Snapshot: magic, format, IP version, generation, count, CRC32 of records
+_snapshot_header = struct.Struct('!4sBBQII')
+# Journal: magic, format, IP version, generation of the snapshot it follows
+_journal_header = struct.Struct('!4sBBQ')
+# Journal batch: count, CRC32 of records
+_batch_header = struct.Struct('!II')
+_format = 1
+
+# Records are the network address and prefix length, journal records are
+# prefixed with a flag byte
+_records = {4: '!IB', 6: '!QQB'}
+_ENABLED = 0x80
+
+class StateError(Exception):
+  pass
+
+def _pack(version, networks):
+  if version == 4:
+    values = []
+    for network in networks:
+      values.extend((network.value, network.prefixlen))
+  else:
+    values = []
+    for network in networks:
+      values.extend((network.value >> 64, network.value & 0xffffffffffffffff, network.prefixlen))
+  return struct.pack('!' + _records[version][1:] * len(networks), *values)
+
+def _unpack(version, data, count):
+  values = struct.unpack('!' + _records[version][1:] * count, data)
+  if version == 4:
+    return [Prefix(4, values[i], values[i + 1]) for i in xrange(0, len(values), 2)]
+  return [Prefix(6, values[i] << 64 | values[i + 1], values[i + 2]) for i in xrange(0, len(values), 3)]
+
+def _crc(data):
+  return zlib.crc32(data) & 0xffffffff
+
+class StateStore(object):
+  # Enabled networks of one IP version: a compacted binary snapshot and an
+  # append-only journal of changes made since
+  def __init__(self, directory, version, compact_threshold = 1024):
+    self.version = version
+    self.compact_threshold = compact_threshold
+    self._snapshot_path = os.path.join(directory, 'ipv{}.snapshot'.format(version))
+    self._journal_path = os.path.join(directory, 'ipv{}.journal'.format(version))
+    self._record = struct.Struct('!B' + _records[version][1:])
+    self._generation = 0
+    self._journal = None
+    self._journaled = 0
+    self._lock = threading.Lock()
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def exists(self):
+    return os.path.exists(self._snapshot_path) or os.path.exists(self._journal_path)
+
+  def _read_snapshot(self):
+    try:
+      f = open(self._snapshot_path, 'rb')
+    except IOError:
+      return 0, set([])
+    data = f.read()
+    f.close()
+    if len(data) < _snapshot_header.size:
+      raise StateError("Snapshot {} is truncated.".format(self._snapshot_path))
+    magic, format, version, generation, count, crc = _snapshot_header.unpack_from(data)
+    if magic != 'IPCS' or format != _format or version != self.version:
+      raise StateError("{} is not an IPv{} snapshot.".format(self._snapshot_path, self.version))
+    body = data[_snapshot_header.size:]
+    if len(body) != count * struct.calcsize(_records[self.version]) or _crc(body) != crc:
+      raise StateError("Snapshot {} is corrupted.".format(self._snapshot_path))
+    return generation, set(_unpack(self.version, body, count))
+
+  def _replay_journal(self, networks):
+    # Apply complete batches, returns the length of the valid part
+    try:
+      f = open(self._journal_path, 'rb')
+    except IOError:
+      return None
+    data = f.read()
+    f.close()
+    if len(data) < _journal_header.size:
+      return None
+    magic, format, version, generation = _journal_header.unpack_from(data)
+    if magic != 'IPCJ' or format != _format or version != self.version or generation != self._generation:
+      # Journal from before the last compaction, already in the snapshot
+      return None
+
+    offset = _journal_header.size
+    while offset + _batch_header.size <= len(data):
+      count, crc = _batch_header.unpack_from(data, offset)
+      end = offset + _batch_header.size + count * self._record.size
+      body = data[offset + _batch_header.size:end]
+      if end > len(data) or _crc(body) != crc:
+        logging.warning("Ignoring incomplete tail of state journal %s.", self._journal_path)
+        break
+      for i in xrange(count):
+        record = self._record.unpack_from(body, i * self._record.size)
+        if self.version == 4:
+          network = Prefix(4, record[1], record[2])
+        else:
+          network = Prefix(6, record[1] << 64 | record[2], record[3])
+        if record[0] & _ENABLED:
+          networks.add(network)
+        else:
+          networks.discard(network)
+      self._journaled += count
+      offset = end
+    return offset
+
+  def load(self):
+    # Enabled networks, or None if there is no stored state yet
+    self._lock.acquire()
+    try:
+      if not self.exists():
+        return None
+      self._generation, networks = self._read_snapshot()
+      self._journaled = 0
+      valid = self._replay_journal(networks)
+      if valid is None:
+        self._reset_journal()
+      else:
+        # Continue after the last complete batch
+        self._journal = open(self._journal_path, 'r+b')
+        self._journal.truncate(valid)
+        self._journal.seek(valid)
+      return networks
+    finally:
+      self._lock.release()
+
+  def _reset_journal(self):
+    if self._journal:
+      self._journal.close()
+    atomic_write(self._journal_path, _journal_header.pack('IPCJ', _format, self.version, self._generation), header = False)
+    self._journal = open(self._journal_path, 'ab')
+    self._journaled = 0
+
+  def append(self, enabled = (), disabled = ()):
+    # Journal one batch of changes, written as a whole
+    records = [self._record.pack(_ENABLED, *self._fields(i)) for i in enabled] + \
+              [self._record.pack(0, *self._fields(i)) for i in disabled]
+    if not records:
+      return
+    body = ''.join(records)
+    self._lock.acquire()
+    try:
+      if not self._journal:
+        self._reset_journal()
+      self._journal.write(_batch_header.pack(len(records), _crc(body)) + body)
+      self._journal.flush()
+      self._journaled += len(records)
+    finally:
+      self._lock.release()
+
+  def _fields(self, network):
+    if self.version == 4:
+      return network.value, network.prefixlen
+    return network.value >> 64, network.value & 0xffffffffffffffff, network.prefixlen
+
+  def sync(self):
+    # Make journaled changes durable
+    self._lock.acquire()
+    try:
+      if self._journal:
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+    finally:
+      self._lock.release()
+
+  def needs_compaction(self, size):
+    return self._journaled >= max(self.compact_threshold, size)
+
+  def pack(self, networks):
+    # Snapshot records of networks, may be prepared before compacting
+    networks = sorted(networks, key = lambda i: (i.value, i.prefixlen))
+    return len(networks), _pack(self.version, networks)
+
+  def compact(self, networks, packed = None):
+    # Replace snapshot and journal with a snapshot of networks, which has
+    # to include all journaled changes. packed is pack(networks), if done.
+    count, body = packed or self.pack(networks)
+    self._lock.acquire()
+    try:
+      generation = self._generation + 1
+      atomic_write(self._snapshot_path, _snapshot_header.pack('IPCS', _format, self.version, generation, count, _crc(body)) + body, header = False)
+      self._generation = generation
+      self._reset_journal()
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      if self._journal:
+        self._journal.close()
+        self._journal = None
+      for path in (self._snapshot_path, self._journal_path):
+        if os.path.exists(path):
+          os.unlink(path)
+      self._generation = 0
+      self._journaled = 0
+    finally:
+      self._lock.release()
+
+  def close(self):
+    self._lock.acquire()
+    try:
+      if self._journal:
+        self._journal.close()
+        self._journal = None
+    finally:
+      self._lock.release()
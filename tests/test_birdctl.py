@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ip_control.birdctl import BirdControl, BirdControlError, BirdReplyError
+from ip_control.fakebird import FakeBirdServer
+
+class BirdControlTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix = 'ip-control-test-')
+    self.path = os.path.join(self.directory, 'bird.ctl')
+    self.server = self.start()
+    self.control = BirdControl(self.path, timeout = 5)
+
+  def tearDown(self):
+    self.control.close()
+    self.server.stop()
+    shutil.rmtree(self.directory, ignore_errors = True)
+
+  def start(self):
+    server = FakeBirdServer(self.path)
+    server.start()
+    return server
+
+  def test_configure(self):
+    self.assertEqual(self.control.configure(), (3, ['Reading configuration from /etc/bird.conf', 'Reconfigured']))
+    self.assertEqual(self.control.configure()[0], 3)
+    self.assertEqual(self.server.configure_count, 2)
+    # Both went over one connection
+    self.assertEqual(len(self.server._connections), 1)
+
+  def test_error_reply(self):
+    self.server.fail = 'syntax error'
+    with self.assertRaises(BirdReplyError) as context:
+      self.control.configure()
+    self.assertEqual(context.exception.code, 8002)
+    self.assertEqual(context.exception.lines, ['syntax error'])
+    # The connection stays usable
+    self.server.fail = None
+    self.assertEqual(self.control.configure()[0], 3)
+
+  def test_reconnect(self):
+    self.control.configure()
+    # BIRD restarted, the old connection is gone
+    self.server.stop()
+    self.server = self.start()
+    self.assertEqual(self.control.configure()[0], 3)
+    self.assertEqual(self.server.configure_count, 1)
+
+  def test_unreachable(self):
+    self.server.stop()
+    with self.assertRaises(BirdControlError) as context:
+      self.control.configure()
+    self.assertFalse(isinstance(context.exception, BirdReplyError))
+
+if __name__ == '__main__':
+  unittest.main()
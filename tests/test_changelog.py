@@ -0,0 +1,74 @@
+import time
+import threading
+import unittest
+from ip_control.changelog import Changelog
+
+class ChangelogTest(unittest.TestCase):
+  def test_since(self):
+    log = Changelog()
+    start = log.seq
+    log.record(enabled = ['a', 'b'])
+    log.record(disabled = ['a'])
+    seq, events, reset = log.since(start)
+    self.assertFalse(reset)
+    self.assertEqual(seq, start + 3)
+    self.assertEqual([(i.network, i.status) for i in events], [('a', 'enabled'), ('b', 'enabled'), ('a', 'disabled')])
+    self.assertEqual([i.seq for i in events], [start + 1, start + 2, start + 3])
+    # Filtered by network, and nothing newer than the latest
+    self.assertEqual([i.status for i in log.since(start, ['a'])[1]], ['enabled', 'disabled'])
+    self.assertEqual(log.since(seq), (seq, [], False))
+
+  def test_reset(self):
+    log = Changelog(size = 2)
+    start = log.seq
+    log.record(enabled = ['a', 'b', 'c'])
+    # The first event is gone already
+    self.assertEqual(log.since(start), (log.seq, [], True))
+    self.assertEqual(len(log.since(start + 1)[1]), 2)
+    # Sequence from the future
+    self.assertTrue(log.since(log.seq + 1)[2])
+
+  def test_restart(self):
+    old = Changelog()
+    old.record(enabled = ['a'])
+    seq = old.seq
+    # New log knows nothing from before it started, even without events
+    log = Changelog()
+    self.assertEqual(log.since(seq), (log.seq, [], True))
+    self.assertEqual(log.since(log.seq), (log.seq, [], False))
+    # Nor after heavy churn of either run, whatever their counts
+    for _ in range(20):
+      old = Changelog()
+      old.record(enabled = ['a'] * 100)
+      log = Changelog()
+      log.record(enabled = ['b'] * 50)
+      self.assertTrue(log.since(old.seq)[2])
+      self.assertTrue(log.since(old.seq - 60)[2])
+      self.assertTrue(log.seq < 2 ** 53)
+
+  def test_wait(self):
+    log = Changelog()
+    start = log.seq
+    timer = threading.Timer(0.1, lambda: log.record(enabled = ['b']))
+    timer.start()
+    # Changes of other networks do not end the wait
+    threading.Timer(0.05, lambda: log.record(enabled = ['a'])).start()
+    started = time.time()
+    seq, events, reset = log.since(start, ['b'], 5)
+    self.assertTrue(time.time() - started < 2)
+    self.assertEqual([i.network for i in events], ['b'])
+    timer.join()
+    # Waiting for nothing times out
+    started = time.time()
+    self.assertEqual(log.since(log.seq, None, 0.1)[1], [])
+    self.assertTrue(time.time() - started >= 0.1)
+
+  def test_subscribe(self):
+    log = Changelog()
+    calls = []
+    log.subscribe(lambda: calls.append(log.seq))
+    log.record(enabled = ['a'])
+    self.assertEqual(calls, [log.seq])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import threading
+import unittest
+import dns.exception
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from ip_control.dnscache import DNSCache
+from standins import StubResolver
+
+class HangingResolver(StubResolver):
+  # Resolver which stops answering until released, then times out
+  def __init__(self, *args, **kwargs):
+    StubResolver.__init__(self, *args, **kwargs)
+    self.down = False
+    self.waiting = 0
+    self.release = threading.Event()
+
+  def query(self, name, rdtype = 'A'):
+    if not self.down:
+      return StubResolver.query(self, name, rdtype)
+    self.queries += 1
+    self.waiting += 1
+    self.release.wait(10)
+    self.waiting -= 1
+    raise dns.exception.Timeout()
+
+class DNSCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.resolver = HangingResolver({('host.test', 'A'): ['10.0.0.1']})
+    self.cache = DNSCache(stale_grace = 300)
+    self.cache._resolver = self.resolver
+
+  def tearDown(self):
+    self.resolver.release.set()
+
+  def expire(self, name, rdtype = 'A', age = 1):
+    entry = self.cache._entries[(name, rdtype)]
+    entry.expires = time.time() - age
+
+  def answer(self, name):
+    return [i.to_text() for i in self.cache.query(name)]
+
+  def wait_for(self, condition, timeout = 5):
+    deadline = time.time() + timeout
+    while not condition():
+      if time.time() > deadline:
+        return False
+      time.sleep(0.01)
+    return True
+
+  def test_cached(self):
+    self.assertEqual(self.answer('host.test'), ['10.0.0.1'])
+    self.assertEqual(self.answer('HOST.test'), ['10.0.0.1'])
+    self.assertEqual(self.resolver.queries, 1)
+
+  def test_stale_while_resolver_hangs(self):
+    self.answer('host.test')
+    self.expire('host.test')
+    self.resolver.down = True
+
+    started = time.time()
+    for _ in range(20):
+      self.assertEqual(self.answer('host.test'), ['10.0.0.1'])
+    self.assertTrue(time.time() - started < 1)
+    # Only one refresh is waiting for the resolver
+    self.assertTrue(self.wait_for(lambda: self.resolver.waiting == 1))
+    time.sleep(0.1)
+    self.assertEqual(self.resolver.queries, 2)
+
+    # Failed refresh keeps the stale answer, the next query tries again
+    self.resolver.release.set()
+    self.assertTrue(self.wait_for(lambda: not self.cache._refreshing))
+    self.resolver.down = False
+    self.assertEqual(self.answer('host.test'), ['10.0.0.1'])
+    self.assertTrue(self.wait_for(lambda: self.cache._entries[('host.test', 'A')].expires > time.time()))
+
+  def test_refresh_replaces_stale(self):
+    self.answer('host.test')
+    self.expire('host.test')
+    self.resolver.records[('host.test', 'A')] = ['10.0.0.2']
+    self.assertEqual(self.answer('host.test'), ['10.0.0.1'])
+    self.assertTrue(self.wait_for(lambda: self.answer('host.test') == ['10.0.0.2']))
+
+  def test_past_stale_grace(self):
+    self.answer('host.test')
+    self.expire('host.test', age = 301)
+    self.resolver.down = True
+    self.resolver.release.set()
+    self.assertRaises(dns.exception.Timeout, self.cache.query, 'host.test')
+
+if __name__ == '__main__':
+  unittest.main()
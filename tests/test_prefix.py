@@ -0,0 +1,47 @@
+import random
+import unittest
+import netaddr
+from ip_control.prefix import Prefix, collapse, parse
+
+class PrefixTest(unittest.TestCase):
+  def test_parse(self):
+    for text in ('10.1.2.3', '10.1.2.0/24', '2001:db8::1', '2001:db8::/32', '0.0.0.0/0'):
+      network = netaddr.IPNetwork(text)
+      self.assertEqual(str(parse(text)), str(network.cidr))
+      self.assertEqual(parse(text), parse(network))
+    # Host bits are dropped
+    self.assertEqual(parse('10.1.2.3/24'), parse('10.1.2.0/24'))
+    self.assertRaises(netaddr.AddrFormatError, parse, '10.0.0.0/33')
+
+  def test_contains(self):
+    self.assertTrue(parse('10.1.2.3') in parse('10.0.0.0/8'))
+    self.assertFalse(parse('10.0.0.0/8') in parse('10.1.0.0/16'))
+    self.assertFalse(parse('::a01:203') in parse('10.0.0.0/8'))
+
+class CollapseTest(unittest.TestCase):
+  def test_siblings(self):
+    networks = [parse('10.0.0.{}'.format(i)) for i in range(8)]
+    self.assertEqual(collapse(networks), [parse('10.0.0.0/29')])
+    self.assertEqual(collapse(networks[1:]), [parse('10.0.0.1/32'), parse('10.0.0.2/31'), parse('10.0.0.4/30')])
+    # Subnets of an included supernet disappear
+    self.assertEqual(collapse([parse('10.0.0.0/24'), parse('10.0.0.7')]), [parse('10.0.0.0/24')])
+    self.assertEqual(collapse([]), [])
+
+  def test_matches_netaddr(self):
+    rng = random.Random(1)
+    for version, base, width in ((4, parse('10.0.0.0/22'), 32), (6, parse('2001:db8::/118'), 128)):
+      for _ in range(50):
+        networks = [Prefix(version, base.value | rng.getrandbits(width - base.prefixlen), rng.choice([width, width, width - 1, width - 3]))
+                    for _ in range(rng.randint(1, 200))]
+        expected = [parse(i) for i in netaddr.cidr_merge([i.to_netaddr() for i in networks])]
+        self.assertEqual(collapse(networks), sorted(expected))
+        # Covers exactly the same addresses
+        self.assertEqual(sum(i.last - i.first + 1 for i in collapse(networks)),
+                         len(set(a for i in networks for a in xrange(i.first - base.value, i.last - base.value + 1))))
+
+  def test_families(self):
+    self.assertEqual(collapse([parse('::'), parse('::1'), parse('0.0.0.0'), parse('0.0.0.1')]),
+                     [parse('0.0.0.0/31'), parse('::/127')])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,50 @@
+import socket
+import logging
+import unittest
+from ip_control import probes
+
+class BrokenRun(probes.TCPProbeRun):
+  def handle(self, events):
+    raise ValueError("broken")
+
+class BrokenProbe(probes.TCPProbe):
+  def _run(self, sock):
+    return BrokenRun(sock)
+
+class UnstartableProbe(probes.TCPProbe):
+  def start(self):
+    raise KeyError("unstartable")
+
+class ProbeLoopTest(unittest.TestCase):
+  def setUp(self):
+    self.server = socket.socket()
+    self.server.bind(('127.0.0.1', 0))
+    self.server.listen(8)
+    self.port = self.server.getsockname()[1]
+    self.loop = probes.ProbeLoop()
+    self.loop.start()
+    logging.disable(logging.CRITICAL)
+
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    self.loop.stop()
+    self.loop.join(5)
+    self.server.close()
+
+  def probe(self, cls):
+    probe = cls('127.0.0.1', self.port)
+    probe.resolve()
+    return probe
+
+  def test_tcp(self):
+    self.assertTrue(self.loop.submit(self.probe(probes.TCPProbe), 5).result(5))
+
+  def test_broken_probe(self):
+    # Only the broken probe fails, the loop keeps serving others
+    self.assertFalse(self.loop.submit(self.probe(BrokenProbe), 5).result(5))
+    self.assertFalse(self.loop.submit(self.probe(UnstartableProbe), 5).result(5))
+    self.assertTrue(self.loop.is_alive())
+    self.assertTrue(self.loop.submit(self.probe(probes.TCPProbe), 5).result(5))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,92 @@
+import random
+import unittest
+from ip_control.prefix import Prefix, parse
+from ip_control.radix import PrefixTrie
+
+def random_networks(rng, version, count):
+  # Networks in a small range, so many of them overlap
+  width = 32 if version == 4 else 128
+  base = parse('10.0.0.0/16' if version == 4 else '2001:db8::/112')
+  networks = set([])
+  while len(networks) < count:
+    prefixlen = rng.randint(base.prefixlen, width)
+    networks.add(Prefix(version, base.value | rng.getrandbits(width - base.prefixlen), prefixlen))
+  return list(networks)
+
+class PrefixTrieTest(unittest.TestCase):
+  def setUp(self):
+    self.rng = random.Random(1)
+
+  def check(self, trie, expected, probes):
+    self.assertEqual(len(trie), len(expected))
+    self.assertEqual(sorted(trie.keys()), sorted(expected))
+    for network in probes:
+      self.assertEqual(network in trie, network in expected)
+      self.assertEqual(trie.get(network), expected.get(network))
+      covering = sorted((i for i in expected if network in i), key = lambda i: i.prefixlen)
+      self.assertEqual([i[0] for i in trie.covering(network)], covering)
+      self.assertEqual(trie.longest_match(network), (covering[-1], expected[covering[-1]]) if covering else None)
+      self.assertEqual(sorted(i[0] for i in trie.within(network)), sorted(i for i in expected if i in network))
+
+  def test_round_trip(self):
+    for version in (4, 6):
+      networks = random_networks(self.rng, version, 300)
+      probes = networks + random_networks(self.rng, version, 100)
+      trie = PrefixTrie()
+      expected = {}
+      for i, network in enumerate(networks):
+        trie[network] = i
+        expected[network] = i
+      self.check(trie, expected, probes)
+
+      # Removing keeps everything else reachable
+      for network in networks[::2]:
+        del trie[network]
+        del expected[network]
+      self.check(trie, expected, probes)
+      for network in networks:
+        trie.remove(network)
+      self.check(trie, {}, probes)
+
+  def test_copy(self):
+    networks = random_networks(self.rng, 4, 300)
+    trie = PrefixTrie()
+    for i, network in enumerate(networks):
+      trie[network] = i
+    expected = dict((network, i) for i, network in enumerate(networks))
+    copy = trie.copy()
+    copied = dict(expected)
+    # Changes of either trie are not seen by the other
+    for network in networks[:100]:
+      del copy[network]
+      del copied[network]
+    for network in networks[100:150]:
+      copy[network] = 'copy'
+      copied[network] = 'copy'
+    for network in networks[150:200]:
+      trie[network] = 'original'
+      expected[network] = 'original'
+    extra = random_networks(self.rng, 4, 20)
+    for network in extra:
+      copy[network] = 'extra'
+      copied[network] = 'extra'
+    self.check(trie, expected, networks + extra)
+    self.check(copy, copied, networks + extra)
+    # Copies of copies as well
+    again = copy.copy()
+    del again[networks[120]]
+    self.assertTrue(networks[120] in copy)
+
+  def test_families_are_separate(self):
+    trie = PrefixTrie()
+    trie[parse('0.0.0.0/0')] = 4
+    self.assertEqual(trie.longest_match(parse('::1')), None)
+    self.assertEqual(trie.longest_match(parse('10.1.2.3')), (parse('0.0.0.0/0'), 4))
+
+  def test_missing_key(self):
+    trie = PrefixTrie()
+    trie[parse('10.0.0.0/8')] = True
+    self.assertRaises(KeyError, lambda: trie[parse('10.0.0.0/9')])
+
+if __name__ == '__main__':
+  unittest.main()
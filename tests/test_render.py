@@ -0,0 +1,89 @@
+import random
+import unittest
+from ip_control.prefix import Prefix, collapse, parse
+from ip_control.radix import PrefixTrie
+from ip_control.render import ConfigRenderer
+
+def networks(*texts):
+  return frozenset(parse(i) for i in texts)
+
+class ConfigRendererTest(unittest.TestCase):
+  def setUp(self):
+    self.interfaces = PrefixTrie()
+    self.interfaces[parse('10.0.0.0/8')] = 'eth0'
+    self.interfaces[parse('10.1.0.0/16')] = 'eth1'
+    self.interfaces[parse('2001:db8::/32')] = 'eth0'
+    self.aggregated = set(['eth1'])
+
+  def get_interface(self, network):
+    match = self.interfaces.longest_match(network)
+    return match[1] if match else 'lo'
+
+  def aggregate(self, interface):
+    return interface in self.aggregated
+
+  def render(self, renderer, enabled, relocated = ()):
+    return renderer.render(enabled, self.get_interface, self.aggregate, relocated)
+
+  def test_render(self):
+    enabled = networks('10.0.0.2', '2001:db8::1', '10.0.0.1', '10.1.0.0', '10.1.0.1', '10.1.0.3', '192.168.0.1')
+    announcements, routes = self.render(ConfigRenderer(), enabled)
+    self.assertEqual(announcements.split('\n'), [
+      'stubnet 10.0.0.1/32;',
+      'stubnet 10.0.0.2/32;',
+      '# enabled 10.1.0.0/32',
+      '# enabled 10.1.0.1/32',
+      'stubnet 10.1.0.0/31; # aggregate of 2 networks',
+      'stubnet 10.1.0.3/32;',
+      'stubnet 192.168.0.1/32;',
+      'stubnet 2001:db8::1/128;'])
+    self.assertEqual(routes.split('\n'), [
+      'route 10.0.0.1/32 via "eth0";',
+      'route 10.0.0.2/32 via "eth0";',
+      'route 10.1.0.0/31 via "eth1";',
+      'route 10.1.0.3/32 via "eth1";',
+      'route 192.168.0.1/32 via "lo";',
+      'route 2001:db8::1/128 via "eth0";'])
+
+  def test_relocated(self):
+    renderer = ConfigRenderer()
+    enabled = networks('10.0.0.1', '10.2.0.1', '10.1.0.1')
+    self.render(renderer, enabled)
+    self.interfaces[parse('10.2.0.0/16')] = 'eth1'
+    # Interfaces are not looked up again unless told so
+    self.assertEqual(self.render(renderer, enabled)[1].split('\n')[2], 'route 10.2.0.1/32 via "eth0";')
+    self.assertEqual(self.render(renderer, enabled, networks('10.2.0.1')), self.render(ConfigRenderer(), enabled))
+
+  def test_matches_full_render(self):
+    rng = random.Random(1)
+    sections = [parse('10.0.{}.0/24'.format(i)) for i in range(8)] + [parse('2001:db8:{}::/48'.format(i)) for i in range(4)]
+    candidates = [Prefix(4, parse('10.0.0.0').value | rng.getrandbits(11), rng.choice([32, 32, 31, 30])) for _ in range(300)] + \
+                 [Prefix(6, parse('2001:db8::').value | (rng.getrandbits(2) << 80) | rng.getrandbits(4), rng.choice([128, 127])) for _ in range(100)]
+    renderer = ConfigRenderer()
+    enabled = frozenset()
+    for step in range(200):
+      relocated = set([])
+      if step % 10 == 0:
+        # Move a section to another interface, aggregated or not
+        section = rng.choice(sections)
+        self.interfaces[section] = rng.choice(['eth0', 'eth1', 'eth2'])
+        relocated = set(i for i in enabled if i in section)
+      changes = set(rng.sample(candidates, rng.choice([1, 1, 2, 5, 50])))
+      enabled = enabled ^ changes
+      self.assertEqual(self.render(renderer, enabled, relocated), self.render(ConfigRenderer(), enabled))
+
+  def test_aggregation_follows_changes(self):
+    # Dense networks of one aggregated interface, merged and split again
+    rng = random.Random(2)
+    base = parse('10.1.0.0').value
+    candidates = [Prefix(4, base | rng.getrandbits(8), rng.choice([32, 32, 32, 31, 30, 28])) for _ in range(400)]
+    renderer = ConfigRenderer()
+    enabled = frozenset()
+    for step in range(300):
+      enabled = enabled ^ set(rng.sample(candidates, rng.choice([1, 1, 1, 3, 40])))
+      self.assertEqual(self.render(renderer, enabled), self.render(ConfigRenderer(), enabled))
+      aggregation = renderer._aggregations.get('eth1')
+      self.assertEqual([Prefix(*i) for i in aggregation.aggregates] if aggregation else [], collapse(enabled))
+
+if __name__ == '__main__':
+  unittest.main()
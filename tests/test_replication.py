@@ -0,0 +1,160 @@
+# Three controllers in one process, each serving and connecting from its
+# own loopback address, replicating ownership of unicast networks.
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import jsonrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from ip_control import configuration, dnscache
+from ip_control.peers import TimeoutTransport
+from ip_control.server import ConcurrentJSONRPCServer
+from standins import StubResolver
+
+IPS = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+CLIENT_IP = '127.0.0.9'
+CONTROL_DOMAIN = 'ip-control.test'
+CLIENT = 'client.test.'
+PORT = 18900
+NETWORK = '10.9.0.0/16'
+
+def wait_for(condition, timeout = 10):
+  deadline = time.time() + timeout
+  while not condition():
+    if time.time() > deadline:
+      return False
+    time.sleep(0.05)
+  return True
+
+class Controllers(object):
+  def __init__(self):
+    self.directory = tempfile.mkdtemp(prefix = 'ip-control-test-')
+    # Only the client has a reverse record, so calls between controllers
+    # are allowed only when they come from the controller's own address
+    self.resolver = StubResolver({
+      (CONTROL_DOMAIN, 'A'): IPS,
+      (CLIENT, 'A'): [CLIENT_IP],
+      ('9.0.0.127.in-addr.arpa', 'PTR'): [CLIENT]
+    })
+    dnscache.cache._resolver = self.resolver
+    dnscache.cache.clear()
+    self.rpcs = []
+    self.servers = []
+    for i, ip in enumerate(IPS):
+      self._start(i, ip)
+
+  def _config(self, index):
+    directory = os.path.join(self.directory, str(index))
+    os.makedirs(directory)
+    path = os.path.join(directory, 'ip-control.conf')
+    output = open(path, 'w')
+    output.write("[General]\n")
+    for option, value in (('ip_control_dns_name', CONTROL_DOMAIN),
+                          ('bird4_dynamic_config', os.path.join(directory, 'dynamic_ipv4.conf')),
+                          ('bird4_dynamic_routes', os.path.join(directory, 'dynamic_ipv4_routes.conf')),
+                          ('bird4_reload', 'true'),
+                          ('bird6_dynamic_config', os.path.join(directory, 'dynamic_ipv6.conf')),
+                          ('bird6_dynamic_routes', os.path.join(directory, 'dynamic_ipv6_routes.conf')),
+                          ('bird6_reload', 'true'),
+                          ('reload_debounce', 0.05),
+                          ('reload_max_delay', 0.2),
+                          ('peer_timeout', 2),
+                          ('replicate_ownership', 'true'),
+                          ('ownership_sync_interval', 1),
+                          ('persistance_file', os.path.join(directory, 'persist'))):
+      output.write("{} = {}\n".format(option, value))
+    output.write("\n[{}]\ninterface = lo\nunicast = true\nallowed_hosts = {}\n".format(NETWORK, CLIENT))
+    output.close()
+    return configuration.init(path)
+
+  def _start(self, index, ip):
+    from ip_control.rpc import RPC
+    # Controllers read their own files when constructed, the rest of the
+    # configuration is the same for all of them
+    self._config(index)
+    rpc = RPC((ip, PORT))
+    server = ConcurrentJSONRPCServer((ip, PORT), logRequests = False)
+    server.register_instance(rpc)
+    thread = threading.Thread(target = server.serve_forever, name = 'controller-{}'.format(ip))
+    thread.daemon = True
+    thread.start()
+    self.rpcs.append(rpc)
+    self.servers.append(server)
+
+  def client(self, index):
+    return jsonrpclib.Server('http://{}:{}/'.format(IPS[index], PORT), transport = TimeoutTransport(10, (CLIENT_IP, 0)))
+
+  def synced(self):
+    return all(rpc._replicator.synced(rpc._controllers()) for rpc in self.rpcs)
+
+  def close(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    for rpc in self.rpcs:
+      rpc._replicator.stop()
+      rpc._close()
+    shutil.rmtree(self.directory, ignore_errors = True)
+
+class ReplicationTest(unittest.TestCase):
+  def setUp(self):
+    self.controllers = Controllers()
+    self.assertTrue(wait_for(self.controllers.synced), "Controllers have not synchronized.")
+
+  def tearDown(self):
+    self.controllers.close()
+
+  def status(self, network):
+    return [rpc.status(network) for rpc in self.controllers.rpcs]
+
+  def owners(self, network):
+    return [rpc.owner(network) for rpc in self.controllers.rpcs]
+
+  def test_enable_asks_only_owner(self):
+    # Fall back to asking everybody is a failure here
+    broadcasts = []
+    for rpc in self.controllers.rpcs:
+      original = rpc._disable_elsewhere
+      rpc._disable_elsewhere = lambda network, controllers, original = original: broadcasts.append(network) or original(network, controllers)
+
+    self.controllers.client(0).enable('10.9.0.1', True)
+    self.assertTrue(wait_for(lambda: self.owners('10.9.0.1') == [IPS[0]] * 3))
+
+    result = self.controllers.client(1).enable('10.9.0.1', True)
+    self.assertEqual(result['status'], 'enabled')
+    self.assertEqual(result['peers'], {IPS[0]: 'disabled'})
+    self.assertEqual(self.status('10.9.0.1'), ['disabled', 'enabled', 'disabled'])
+    self.assertTrue(wait_for(lambda: self.owners('10.9.0.1') == [IPS[1]] * 3))
+
+    self.controllers.client(1).disable('10.9.0.1', True)
+    self.assertEqual(self.status('10.9.0.1'), ['disabled'] * 3)
+    self.assertTrue(wait_for(lambda: self.owners('10.9.0.1') == [None] * 3))
+    self.assertEqual(broadcasts, [])
+
+  def test_partition_heals(self):
+    self.controllers.client(0).enable('10.9.0.5', True)
+    self.assertTrue(wait_for(lambda: self.owners('10.9.0.5') == [IPS[0]] * 3))
+
+    # The first controller cannot be reached by the others
+    def fail(*args):
+      raise socket.error("partitioned")
+    for rpc in self.controllers.rpcs[1:]:
+      rpc._peers.get(IPS[0]).call = fail
+    self.controllers.client(1).enable('10.9.0.5', True)
+    self.assertEqual(self.status('10.9.0.5'), ['enabled', 'enabled', 'disabled'])
+
+    for rpc in self.controllers.rpcs[1:]:
+      del rpc._peers.get(IPS[0]).call
+    # Synchronization tells the first controller it has lost the network
+    self.assertTrue(wait_for(lambda: self.status('10.9.0.5') == ['disabled', 'enabled', 'disabled']))
+    self.assertTrue(wait_for(lambda: self.owners('10.9.0.5') == [IPS[1]] * 3))
+    self.assertEqual(len(set(rpc._ownership.digest() for rpc in self.controllers.rpcs)), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,142 @@
+import time
+import errno
+import struct
+import unittest
+from ip_control import routes
+from ip_control.changelog import Changelog
+from ip_control.prefix import parse
+
+class Bird(object):
+  # Enabled networks and their interfaces, as BirdConfig.routes() has them
+  def __init__(self, routes = None):
+    self.desired = dict((parse(network), interface) for network, interface in (routes or {}).items())
+
+  def routes(self):
+    return dict(self.desired)
+
+class ReconcilerTest(unittest.TestCase):
+  def setUp(self):
+    self.backend = routes.FakeBackend()
+    self.birds = {4: Bird(), 6: Bird()}
+    self.reconciler = routes.RouteReconciler(self.backend, lambda: self.birds, interval = 0.1)
+
+  def kernel(self, version = 4):
+    return dict((str(network), interface) for network, interface in self.backend.routes[version].items())
+
+  def test_diff(self):
+    self.birds[4] = Bird({'10.0.0.1/32': 'eth0', '10.0.0.2/32': 'eth1'})
+    self.birds[6] = Bird({'2001:db8::1/128': 'eth0'})
+    self.backend.routes[4][parse('10.0.0.2/32')] = 'eth0'
+    self.backend.routes[4][parse('10.0.0.9/32')] = 'eth0'
+
+    self.assertEqual(self.reconciler.reconcile(), 4)
+    self.assertEqual(self.kernel(), {'10.0.0.1/32': 'eth0', '10.0.0.2/32': 'eth1'})
+    self.assertEqual(self.kernel(6), {'2001:db8::1/128': 'eth0'})
+    # Only the difference is applied, in one batch per family
+    version, add, remove = self.backend.batches[0]
+    self.assertEqual((version, sorted(map(str, add)), map(str, remove)), (4, ['10.0.0.1/32', '10.0.0.2/32'], ['10.0.0.9/32']))
+
+    batches = len(self.backend.batches)
+    self.assertEqual(self.reconciler.reconcile(), 0)
+    self.assertEqual(len(self.backend.batches), batches)
+
+  def test_failures_are_retried(self):
+    self.birds[4] = Bird({'10.0.0.1/32': 'eth9'})
+    self.backend.fail.add('eth9')
+    self.assertEqual(self.reconciler.reconcile(), 0)
+    self.assertEqual(self.kernel(), {})
+    self.backend.fail.clear()
+    self.assertEqual(self.reconciler.reconcile(), 1)
+    self.assertEqual(self.kernel(), {'10.0.0.1/32': 'eth9'})
+
+  def test_foreign_routes(self):
+    # Routes of other protocols are errors, not replaced, ours are
+    self.birds[4] = Bird({'10.0.0.1/32': 'eth0', '10.0.0.2/32': 'eth1'})
+    self.backend.foreign[4][parse('10.0.0.1/32')] = 'eth9'
+    self.backend.routes[4][parse('10.0.0.2/32')] = 'eth0'
+    self.assertEqual(self.reconciler.reconcile(), 1)
+    self.assertEqual(self.kernel(), {'10.0.0.2/32': 'eth1'})
+    self.assertEqual(self.backend.foreign[4], {parse('10.0.0.1/32'): 'eth9'})
+
+  def test_changes_and_drift(self):
+    changelog = Changelog()
+    changelog.subscribe(self.reconciler.wake)
+    self.reconciler._interval = 60
+    self.reconciler.start()
+    try:
+      self.birds[4] = Bird({'10.0.0.1/32': 'eth0'})
+      changelog.record(enabled = [parse('10.0.0.1/32')])
+      self.assertTrue(self.wait_for(lambda: self.kernel() == {'10.0.0.1/32': 'eth0'}))
+
+      # Routes removed by somebody else come back on the next pass
+      self.reconciler._interval = 0.1
+      self.reconciler.wake()
+      self.backend.routes[4].clear()
+      self.assertTrue(self.wait_for(lambda: self.kernel() == {'10.0.0.1/32': 'eth0'}))
+    finally:
+      self.reconciler.stop()
+      self.reconciler.join(5)
+    self.assertFalse(self.reconciler.is_alive())
+
+  def wait_for(self, condition, timeout = 5):
+    deadline = time.time() + timeout
+    while not condition():
+      if time.time() > deadline:
+        return False
+      time.sleep(0.01)
+    return True
+
+class NetlinkMessageTest(unittest.TestCase):
+  def test_attributes(self):
+    data = routes._attribute(routes.RTA_DST, '\x0a\x00\x00\x01') + routes._attribute(routes.RTA_OIF, struct.pack('=I', 7)) + \
+           routes._attribute(routes.RTA_TABLE, '\x01')
+    self.assertEqual(len(data) % 4, 0)
+    attributes = routes._attributes(data)
+    self.assertEqual(attributes[routes.RTA_DST], '\x0a\x00\x00\x01')
+    self.assertEqual(struct.unpack('=I', attributes[routes.RTA_OIF])[0], 7)
+    self.assertEqual(attributes[routes.RTA_TABLE], '\x01')
+
+  def backend(self, code = lambda flags: 0, **kwargs):
+    # Backend acknowledging each message of the last write with code(flags)
+    backend = routes.NetlinkBackend(**kwargs)
+    self.writes = []
+    writes = self.writes
+    class Socket(object):
+      def send(self, data):
+        writes.append(data)
+      def close(self):
+        pass
+    backend._socket = lambda: Socket()
+    def messages(sock):
+      offset, data = 0, writes[-1]
+      while offset < len(data):
+        length, _, flags, seq, _ = routes._nlmsghdr.unpack_from(data, offset)
+        yield routes.NLMSG_ERROR, 0, seq, struct.pack('=i', code(flags))
+        offset += length
+    backend._messages = messages
+    return backend
+
+  def test_batches(self):
+    # Writes are limited by message count, so acknowledgements fit
+    backend = self.backend(batch_messages = 3)
+    add = dict((parse('10.0.0.{}/32'.format(i)), 'lo') for i in range(7))
+    self.assertEqual(backend.apply(4, add, []), {})
+    self.assertEqual(len(self.writes), 3)
+
+  def test_existing_routes(self):
+    # Only routes of ours are replaced, the kernel refuses to create others
+    # which exist already
+    backend = self.backend(lambda flags: -errno.EEXIST if flags & routes.NLM_F_EXCL else 0)
+    ours, foreign = parse('10.0.0.1/32'), parse('10.0.0.2/32')
+    errors = backend.apply(4, {ours: 'lo', foreign: 'lo'}, [], [ours])
+    self.assertEqual(errors.keys(), [foreign])
+    flags = []
+    offset, data = 0, self.writes[0]
+    while offset < len(data):
+      length, _, message_flags, _, _ = routes._nlmsghdr.unpack_from(data, offset)
+      flags.append(message_flags & (routes.NLM_F_REPLACE | routes.NLM_F_EXCL))
+      offset += length
+    self.assertEqual(sorted(flags), [routes.NLM_F_REPLACE, routes.NLM_F_EXCL])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ip_control.prefix import parse
+from ip_control.state import StateError, StateStore
+
+def networks(*texts):
+  return set(parse(i) for i in texts)
+
+class StateStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix = 'ip-control-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors = True)
+
+  def reopen(self, store, version = 4):
+    store.close()
+    store = StateStore(self.directory, version)
+    return store, store.load()
+
+  def test_empty(self):
+    store = StateStore(self.directory, 4)
+    self.assertFalse(store.exists())
+    self.assertEqual(store.load(), None)
+
+  def test_journal_round_trip(self):
+    for version, texts in ((4, ('10.0.0.1/32', '10.0.0.0/24', '192.168.1.0/30')),
+                           (6, ('2001:db8::1/128', '2001:db8::/64', 'fd00::/8'))):
+      store = StateStore(self.directory, version)
+      store.compact(networks(texts[0]))
+      store.append(enabled = networks(*texts[1:]))
+      store.append(disabled = networks(texts[0]))
+      store.sync()
+      store, loaded = self.reopen(store, version)
+      self.assertEqual(loaded, networks(*texts[1:]))
+
+      # Compaction keeps the state and empties the journal
+      store.compact(loaded)
+      self.assertFalse(store.needs_compaction(0))
+      store, loaded = self.reopen(store, version)
+      self.assertEqual(loaded, networks(*texts[1:]))
+      store.close()
+
+  def test_torn_tail(self):
+    store = StateStore(self.directory, 4)
+    store.compact(set([]))
+    store.append(enabled = networks('10.0.0.1'))
+    store.append(enabled = networks('10.0.0.2', '10.0.0.3'))
+    store.close()
+    journal = os.path.join(self.directory, 'ipv4.journal')
+    size = os.path.getsize(journal)
+    # Crash in the middle of writing the last batch
+    f = open(journal, 'r+b')
+    f.truncate(size - 3)
+    f.close()
+
+    store = StateStore(self.directory, 4)
+    self.assertEqual(store.load(), networks('10.0.0.1'))
+    # Appending continues after the last complete batch
+    store.append(enabled = networks('10.0.0.4'))
+    store, loaded = self.reopen(store)
+    self.assertEqual(loaded, networks('10.0.0.1', '10.0.0.4'))
+    store.close()
+
+  def test_corrupted_batch(self):
+    store = StateStore(self.directory, 4)
+    store.compact(set([]))
+    store.append(enabled = networks('10.0.0.1'))
+    store.append(enabled = networks('10.0.0.2'))
+    store.close()
+    journal = os.path.join(self.directory, 'ipv4.journal')
+    f = open(journal, 'r+b')
+    f.seek(-1, os.SEEK_END)
+    f.write('\xff')
+    f.close()
+    store = StateStore(self.directory, 4)
+    self.assertEqual(store.load(), networks('10.0.0.1'))
+    store.close()
+
+  def test_corrupted_snapshot(self):
+    store = StateStore(self.directory, 4)
+    store.compact(networks('10.0.0.1', '10.0.0.2'))
+    store.close()
+    snapshot = os.path.join(self.directory, 'ipv4.snapshot')
+    data = open(snapshot, 'rb').read()
+    open(snapshot, 'wb').write(data[:-1] + chr(ord(data[-1]) ^ 1))
+    self.assertRaises(StateError, StateStore(self.directory, 4).load)
+    # Snapshot of the other family is not accepted either
+    os.rename(snapshot, os.path.join(self.directory, 'ipv6.snapshot'))
+    self.assertRaises(StateError, StateStore(self.directory, 6).load)
+
+  def test_stale_journal(self):
+    # A journal from before the last compaction is already in the snapshot
+    store = StateStore(self.directory, 4)
+    store.compact(set([]))
+    store.append(enabled = networks('10.0.0.1'))
+    journal = open(os.path.join(self.directory, 'ipv4.journal'), 'rb').read()
+    store.compact(networks('10.0.0.2'))
+    store.close()
+    open(os.path.join(self.directory, 'ipv4.journal'), 'wb').write(journal)
+    store = StateStore(self.directory, 4)
+    self.assertEqual(store.load(), networks('10.0.0.2'))
+    store.close()
+
+  def test_clear(self):
+    store = StateStore(self.directory, 4)
+    store.compact(networks('10.0.0.1'))
+    store.clear()
+    self.assertFalse(store.exists())
+
+if __name__ == '__main__':
+  unittest.main()